@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Benchmarks for building, solving and exporting synthetic sheds. The
+# sheds are the one in vaja.py with the walls, the stud spacing and the
+# number of buildings scaled, so every building block of vaja.py gets
+# exercised. Every phase is run twice: once for the wall time and once
+# under tracemalloc for the peak memory, tracing slows Python down too
+# much for the times to mean anything.
+#
+#   ./benchmark.py --save baseline.json
+#   ./benchmark.py --compare baseline.json
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import subprocess
+import tracemalloc
+
+from woods import WoodSystem
+from constraint_system import Dimension
+from template import Template
+import vaja
+
+# name: (buildings, wall width, stud spacing, doors placed from a template)
+sizes = {
+    "small": (1, 3000, 600, False),
+    "wide": (1, 12000, 600, False),
+    "dense": (1, 3000, 150, False),
+    "village": (8, 3000, 600, False),
+    "templated": (8, 3000, 600, True),
+    "large": (4, 12000, 300, False),
+}
+
+quick_sizes = ("small", "dense")
+
+phases = ("build", "solve", "index", "export", "mesh", "cut list")
+
+# Cladding overhang on the default shed, kept for the wider ones.
+cladding_margin = math.sqrt(10000000) - 3000
+
+building_gap = 2000
+
+def generate(system, buildings, wall_width, stud_spacing, templates=False):
+    door_template = Template(vaja.door, Dimension.X) if templates else None
+    for i in range(buildings):
+        with system.assembly("shed {}".format(i)):
+            vaja.shed(
+                    system,
+                    x_offset=i*(wall_width + cladding_margin + building_gap),
+                    wall_width=wall_width,
+                    cladding_width=wall_width + cladding_margin,
+                    stud_spacing=stud_spacing,
+                    door_template=door_template)
+    if system.unsatisfied_binds():
+        raise RuntimeError("Generated model has unsatisfied binds.")
+
+def count_faces(system):
+    return sum(len(graph.faces) for graph in system.graphs.values())
+
+def count_edges(system):
+    return sum(sum(graph.alive)//2 for graph in system.graphs.values())
+
+def query_all(system):
+    system.get_spatial_index()
+    for block in system.blocks:
+        system.query_block(block)
+
+def run_phases(
+        buildings, wall_width, stud_spacing, templates, measure, stats=False):
+    # measure(function) runs function and returns its cost
+    system = WoodSystem(stats=stats)
+    actions = {
+        "build": lambda: generate(
+                system, buildings, wall_width, stud_spacing, templates),
+        "solve": system.solve,
+        "index": lambda: query_all(system),
+        "export": lambda: system.create_openscad(io.StringIO(), streaming=True),
+        "mesh": lambda: system.create_mesh(io.BytesIO(), format="stl"),
+        "cut list": system.create_cut_list,
+    }
+    results = {}
+    for phase in phases:
+        cost = measure(actions[phase])
+        results[phase] = {
+            "cost": cost,
+            "blocks": len(system.blocks),
+            "faces": count_faces(system),
+            "edges": count_edges(system),
+        }
+        if stats:
+            results[phase]["stats"] = system.stats(reset=True)
+    if stats:
+        # stop counting DistanceConstraints of the next runs
+        system.counters.enable(False)
+    return results
+
+def measure_time(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+def measure_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def benchmark(size_names, repeat=1):
+    results = {}
+    for name in size_names:
+        timed = [run_phases(*sizes[name], measure_time)
+                for i in range(repeat)]
+        traced = run_phases(*sizes[name], measure_memory)
+        results[name] = {}
+        for phase in phases:
+            result = dict(traced[phase])
+            del result["cost"]
+            result["time"] = min(run[phase]["cost"] for run in timed)
+            result["peak memory"] = traced[phase]["cost"]
+            results[name][phase] = result
+    return results
+
+def collect_stats(size_names):
+    # solver counters per phase, from a separate untimed run
+    return {name: {phase: result["stats"]
+                for phase, result in run_phases(*sizes[name],
+                    lambda function: function(), stats=True).items()}
+            for name in size_names}
+
+# Importing vaja.py is the startup cost of every command. None of these
+# should be imported until a command needs them.
+heavy_modules = ("solid", "pdb", "traceback", "numpy", "scipy", "benchmark")
+
+startup_code = """
+import sys, time
+start = time.perf_counter()
+import vaja
+print(time.perf_counter() - start, *(name for name in {!r}
+    if name in sys.modules))
+""".format(heavy_modules)
+
+def measure_startup(repeat=1):
+    # import time of vaja.py in fresh interpreters, and the heavy modules
+    # it imported
+    times = []
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, "-c", startup_code],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                check=True, capture_output=True, text=True).stdout.split()
+        times.append(float(output[0]))
+    return {"time": min(times), "heavy modules": output[1:]}
+
+def compare(results, baseline, tolerance):
+    # Returns the regressions as printable lines. Times and memory may
+    # grow by the tolerance, the counts have to stay the same.
+    regressions = []
+    for name, phase_results in results.items():
+        for phase, result in phase_results.items():
+            base = baseline.get(name, {}).get(phase)
+            if base is None:
+                continue
+            for key in ("time", "peak memory"):
+                if key not in result or key not in base:
+                    continue
+                if result[key] > base[key]*(1 + tolerance):
+                    regressions.append("{} {}: {} {:.4g} > {:.4g}".format(
+                        name, phase, key, result[key], base[key]))
+            for key in ("blocks", "faces", "edges", "heavy modules"):
+                if key not in result or key not in base:
+                    continue
+                if result[key] != base[key]:
+                    regressions.append("{} {}: {} {} != {}".format(
+                        name, phase, key, result[key], base[key]))
+    return regressions
+
+def format_results(results):
+    lines = ["{:10} {:10} {:>10} {:>12} {:>8} {:>8} {:>8}".format(
+        "size", "phase", "time (s)", "peak (kB)", "blocks", "faces", "edges")]
+    for name, phase_results in results.items():
+        for phase, result in phase_results.items():
+            lines.append(
+                    "{:10} {:10} {:10.4f} {:12.1f} {:8} {:8} {:8}".format(
+                        name, phase, result["time"],
+                        result["peak memory"]/1024, result["blocks"],
+                        result["faces"], result["edges"]))
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Benchmark Vaja on synthetic sheds.")
+    parser.add_argument("sizes", nargs="*",
+            help="model sizes to run, all by default: " + ", ".join(sizes))
+    parser.add_argument("--quick", action="store_true",
+            help="run only the small models")
+    parser.add_argument("--repeat", type=int, default=3,
+            help="timed runs per model, the fastest counts")
+    parser.add_argument("--startup", action="store_true",
+            help="measure the import time of vaja.py too")
+    parser.add_argument("--stats", action="store_true",
+            help="print the solver counters of every phase")
+    parser.add_argument("--save", metavar="FILE",
+            help="store the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE",
+            help="fail if the results are worse than the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+            help="allowed relative growth of time and memory")
+    args = parser.parse_args(argv)
+
+    size_names = args.sizes or (quick_sizes if args.quick else list(sizes))
+    for name in size_names:
+        if name not in sizes:
+            parser.error("unknown size: " + name)
+    results = benchmark(size_names, args.repeat)
+    print(format_results(results))
+    if args.startup:
+        startup = measure_startup(args.repeat)
+        print("startup: {:.1f} ms, heavy modules: {}".format(
+            startup["time"]*1000,
+            ", ".join(startup["heavy modules"]) or "none"))
+        results["startup"] = {"import": startup}
+    if args.stats:
+        print(json.dumps(collect_stats(size_names), indent=2))
+
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("Regression:", regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,12 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import sys
-import pdb
-import traceback
+import math
+import heapq
+import itertools
+import array
+import weakref
+import contextlib
+import collections
 
 from enum import Enum, auto
 
+from spatial_index import SpatialIndex
+
 def debug():
+    # pdb and traceback are imported only when needed, they are slow to
+    # import and nothing else uses them
+    import pdb
+    import traceback
     tyoe, value, tb = sys.exc_info()
     traceback.print_exc()
     pdb.post_mortem(tb)
@@ -29,8 +40,62 @@ class Equality(Enum):
 class DistanceNotConstrainedException(Exception):
     pass
 
+class ConstraintConflictException(Exception):
+    pass
+
+class UnderconstrainedException(Exception):
+    pass
+
+class Stats:
+    # Counters of the solver hot paths, see ConstraintSystem.stats(). The
+    # hot paths only check enabled when the counters are off, anything
+    # that takes extra work to count is computed after the fact.
+    # DistanceConstraints don't belong to a system, their allocations are
+    # counted in every enabled Stats that is still in use.
+    active = weakref.WeakSet()
+
+    def __init__(self, enabled=False):
+        self.counts = collections.Counter()
+        self.maxima = {}
+        self.enabled = False
+        self.enable(enabled)
+
+    def enable(self, enabled=True):
+        if enabled and not self.enabled:
+            Stats.active.add(self)
+        elif not enabled and self.enabled:
+            Stats.active.discard(self)
+        self.enabled = enabled
+
+    def count(self, key, n=1):
+        self.counts[key] += n
+
+    def maximum(self, key, value):
+        if value > self.maxima.get(key, 0):
+            self.maxima[key] = value
+
+    def reset(self):
+        self.counts.clear()
+        self.maxima.clear()
+
+    def as_dict(self):
+        # {"get_distance": {"calls": 3, ...}, "solve_dimension": {"X": {...
+        result = {}
+        for counters in (self.counts, self.maxima):
+            for key, value in counters.items():
+                level = result
+                for name in key[:-1]:
+                    level = level.setdefault(name, {})
+                level[key[-1]] = value
+        return result
+
+Stats.disabled = Stats()
+
 class DistanceConstraint:
     def __init__(self, operand, value):
+        if Stats.active:
+            for stats in Stats.active:
+                stats.count(("DistanceConstraint", "allocations"))
         self.value = value
         if operand == ">" or operand == Equality.GT:
             self.equality = Equality.GT
@@ -81,83 +146,1527 @@ class DistanceConstraint:
                         Equality.EQ, self.value + other.value)
 
         else:
-            pdb.set_trace()
+            import pdb; pdb.set_trace()
             raise NotImplementedError
 
     def __radd__(self, other):
         return DistanceConstraint.__add__(self, other)
 
-class ConstraintSystem:
+class Parameter(float):
+    # A named bind offset, or a linear expression of named offsets, that
+    # ConstraintSystem.compile() turns into a column of its linear map.
+    # Linear arithmetic keeps the names, anything else gives plain floats.
+    # The face graphs store the plain value, so solving is not affected.
+    __slots__ = ("value", "terms", "values")
+
+    def __new__(cls, value, name=None, terms=None, values=None):
+        parameter = super().__new__(cls, value)
+        # the number in its original type
+        parameter.value = value
+        if name is not None:
+            terms = {name: 1}
+            values = {name: value}
+        # name: coefficient
+        parameter.terms = terms
+        # name: value of the named parameter
+        parameter.values = values
+        return parameter
+
+    def __repr__(self):
+        return "Parameter({!r}, {})".format(self.value, " + ".join(
+            "{}*{}".format(coefficient, name)
+            for name, coefficient in self.terms.items()))
+
+    def __neg__(self):
+        return Parameter(-self.value, terms={name: -coefficient
+            for name, coefficient in self.terms.items()}, values=self.values)
+
+    def __add__(self, other):
+        if isinstance(other, Parameter):
+            terms = dict(self.terms)
+            for name, coefficient in other.terms.items():
+                terms[name] = terms.get(name, 0) + coefficient
+            return Parameter(self.value + other.value, terms=terms,
+                    values={**self.values, **other.values})
+        if isinstance(other, (int, float)):
+            return Parameter(self.value + other, terms=self.terms,
+                    values=self.values)
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self + -other
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, other):
+        if isinstance(other, Parameter):
+            return float(self)*float(other)
+        if isinstance(other, (int, float)):
+            return Parameter(self.value*other, terms={name: coefficient*other
+                for name, coefficient in self.terms.items()},
+                values=self.values)
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, Parameter):
+            return float(self)/float(other)
+        if isinstance(other, (int, float)):
+            return self*(1/other)
+        return NotImplemented
+
+class Numbers:
+    # A list of numbers kept as float64 values and a kind per item instead
+    # of boxed objects, about 9 bytes an item. Ints and floats come back
+    # in their own type, None as None and anything else (DistanceConstraints,
+    # ints too large for a float64) is kept aside by index.
+    __slots__ = ("values", "kinds", "objects")
+
+    # kinds
+    INT = 0
+    FLOAT = 1
+    NONE = 2
+    OBJECT = 3
+
+    def __init__(self, numbers=()):
+        self.values = array.array('d')
+        self.kinds = bytearray()
+        # index: object of kind OBJECT
+        self.objects = {}
+        self.extend(numbers)
+
+    @classmethod
+    def repeat(cls, number, count):
+        numbers = cls()
+        numbers.append(number)
+        numbers.values *= count
+        numbers.kinds *= count
+        if numbers.objects:
+            numbers.objects = dict.fromkeys(range(count), number)
+        return numbers
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, i):
+        kind = self.kinds[i]
+        if kind == 1:
+            return self.values[i]
+        if kind == 0:
+            return int(self.values[i])
+        if kind == 2:
+            return None
+        return self.objects[i % len(self.kinds)]
+
+    def __setitem__(self, i, number):
+        # the kinds are written out as numbers in the hot paths
+        number_type = type(number)
+        if number_type is float:
+            self.values[i] = number
+            self.kinds[i] = 1
+        elif number_type is int and -2**53 <= number <= 2**53:
+            self.values[i] = number
+            self.kinds[i] = 0
+        else:
+            if i < 0:
+                i += len(self.kinds)
+            self.values[i] = math.nan
+            if number is None:
+                self.kinds[i] = 2
+            else:
+                self.kinds[i] = 3
+                self.objects[i] = number
+                return
+        if self.objects:
+            self.objects.pop(i % len(self.kinds), None)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self):
+        numbers = self.values.tolist()
+        for i, kind in enumerate(self.kinds):
+            if kind == 0:
+                numbers[i] = int(numbers[i])
+            elif kind == 2:
+                numbers[i] = None
+            elif kind == 3:
+                numbers[i] = self.objects[i]
+        return numbers
+
+    def append(self, number):
+        number_type = type(number)
+        if number_type is float:
+            self.values.append(number)
+            self.kinds.append(1)
+        elif number_type is int and -2**53 <= number <= 2**53:
+            self.values.append(number)
+            self.kinds.append(0)
+        else:
+            self.values.append(math.nan)
+            if number is None:
+                self.kinds.append(2)
+            else:
+                self.objects[len(self.kinds)] = number
+                self.kinds.append(3)
+
+    def extend(self, numbers):
+        if isinstance(numbers, Numbers):
+            base = len(self.kinds)
+            self.values.extend(numbers.values)
+            self.kinds.extend(numbers.kinds)
+            self.objects.update((i + base, number)
+                    for i, number in numbers.objects.items())
+        else:
+            for number in numbers:
+                self.append(number)
+
+class BoundGraph:
+    # Inequality binds of one dimension as a difference-constraint graph
+    # between the disjoint-sets of exactly bound faces. An edge u -> v with
+    # weight w means s(v) - s(u) <= w, so the shortest path from u to v is
+    # the tightest upper bound of s(v) - s(u). Shortest paths between all
+    # sets are computed in one go (Johnson's algorithm) and kept until a
+    # bind changes the graph.
+    def __init__(self, dimension: Dimension):
+        self.dimension = dimension
+        # (face_0, face_1): constraint of face_1.s - face_0.s
+        self.constraints = {}
+        self.distances = None
+
+    def add(self, face_0, face_1, constraint):
+        self.constraints[(face_0, face_1)] = constraint
+        self.invalidate()
+
+    def remove(self, face_0, face_1):
+        self.constraints.pop((face_0, face_1), None)
+        self.constraints.pop((face_1, face_0), None)
+        self.invalidate()
+
+    def invalidate(self):
+        self.distances = None
+
+    def compute(self):
+        edges = {}
+        for (face_0, face_1), constraint in self.constraints.items():
+            root_0, offset_0 = face_0.find()
+            root_1, offset_1 = face_1.find()
+            weight = constraint.value - offset_1 + offset_0
+            edges.setdefault(root_0, [])
+            edges.setdefault(root_1, [])
+            if constraint.equality != Equality.GT:
+                edges[root_0].append((root_1, weight))
+            if constraint.equality != Equality.LT:
+                edges[root_1].append((root_0, -weight))
+
+        # Bellman-Ford from a virtual source bound to every set gives
+        # potentials that make all edge weights non-negative.
+        potential = dict.fromkeys(edges, 0)
+        for i in range(len(edges) + 1):
+            changed = False
+            for u, u_edges in edges.items():
+                for v, weight in u_edges:
+                    if potential[u] + weight < potential[v]:
+                        potential[v] = potential[u] + weight
+                        changed = True
+            if not changed:
+                break
+        else:
+            raise ConstraintConflictException(
+                    "Inequality binds in dimension {} contradict each other."
+                    .format(self.dimension.name))
+
+        distances = {}
+        for source in edges:
+            reduced = {source: 0}
+            heap = [(0, id(source), source)]
+            while heap:
+                distance, _, u = heapq.heappop(heap)
+                if distance > reduced[u]:
+                    continue
+                for v, weight in edges[u]:
+                    new_distance = (
+                            distance + weight + potential[u] - potential[v])
+                    if v not in reduced or new_distance < reduced[v]:
+                        reduced[v] = new_distance
+                        heapq.heappush(heap, (new_distance, id(v), v))
+            distances[source] = {
+                    v: distance - potential[source] + potential[v]
+                    for v, distance in reduced.items()}
+        self.distances = distances
+
+    def get_bounds(self, face_0, face_1):
+        root_0, offset_0 = face_0.find()
+        root_1, offset_1 = face_1.find()
+        if root_0 is root_1:
+            return offset_1 - offset_0, offset_1 - offset_0
+        if self.distances is None:
+            self.compute()
+        upper = self.distances.get(root_0, {}).get(root_1, math.inf)
+        lower = -self.distances.get(root_1, {}).get(root_0, math.inf)
+        return lower + offset_1 - offset_0, upper + offset_1 - offset_0
+
+class FaceGraph:
+    # Faces of one dimension and the binds between them in flat arrays.
+    # A face is an integer id, Face objects are only handles to it. Every
+    # bind is a pair of half-edges 2k and 2k + 1 kept in per-face linked
+    # lists (head, tail and next_edge), removed binds are only marked dead
+    # until there are enough of them to compact the arrays. Offsets and
+    # positions are Numbers, so exact ints and DistanceConstraints survive.
+    def __init__(self, dimension: Dimension, system=None):
+        self.dimension = dimension
+        self.system = system
+        self.bounds = BoundGraph(dimension) if system is not None else None
+        self.counters = system.counters if system is not None else Stats.disabled
+        self.version = 0
+        self.csr_cache = None
+        self.snapshot_cache = None
+        # ids of faces whose exact binds changed since the last solve,
+        # None until the graph has been solved once
+        self.touched = None
+
+        self.faces = []
+        self.head = array.array('l')
+        self.tail = array.array('l')
+        # solved positions, None when not solved
+        self.s = Numbers()
+        # weighted disjoint-set of faces bound with exact offsets:
+        # s[i] == s[parent[i]] + parent_offset[i]
+        self.parent = array.array('l')
+        self.parent_offset = Numbers()
+        self.rank = array.array('b')
+        # generation of the disjoint-set rooted at i, bumped whenever the
+        # set or the offsets in it change
+        self.generations = array.array('l')
+        self.generation = 0
+
+        self.edge_face = array.array('l')
+        self.next_edge = array.array('l')
+        self.alive = bytearray()
+        self.offsets = Numbers()
+        self.dead_edges = 0
+        # even half-edge: the Parameter it was bound with
+        self.parameters = {}
+
+    def add_face(self, face):
+        face_id = len(self.faces)
+        self.faces.append(face)
+        self.head.append(-1)
+        self.tail.append(-1)
+        # s[face_id] = None and parent_offset[face_id] = 0
+        self.s.values.append(math.nan)
+        self.s.kinds.append(Numbers.NONE)
+        self.parent.append(face_id)
+        self.parent_offset.values.append(0)
+        self.parent_offset.kinds.append(Numbers.INT)
+        self.rank.append(0)
+        self.generations.append(0)
+        return face_id
+
+    def touch(self, face):
+        if self.touched is not None:
+            self.touched.append(face)
+
+    def append_half_edge(self, face_0, face_1, offset):
+        edge = len(self.edge_face)
+        self.edge_face.append(face_1)
+        self.next_edge.append(-1)
+        self.alive.append(1)
+        self.offsets.append(offset)
+        if self.tail[face_0] == -1:
+            self.head[face_0] = edge
+        else:
+            self.next_edge[self.tail[face_0]] = edge
+        self.tail[face_0] = edge
+
+    def add_edge(self, face_0, face_1, offset):
+        # returns the offset as it is stored, without a Parameter
+        if isinstance(offset, Parameter):
+            self.parameters[len(self.edge_face)] = offset
+            offset = offset.value
+        self.append_half_edge(face_0, face_1, offset)
+        self.append_half_edge(face_1, face_0, -offset)
+        self.version += 1
+        return offset
+
+    def remove_edges(self, face_0, face_1):
+        if self.counters.enabled:
+            self.counters.count(("remove_neighbor", "calls"))
+            self.counters.count(("remove_neighbor", "edges scanned"),
+                    self.degree(face_0))
+        removed = []
+        edge = self.head[face_0]
+        while edge != -1:
+            if self.alive[edge] and self.edge_face[edge] == face_1:
+                removed.append(self.offsets[edge])
+                self.alive[edge] = 0
+                self.alive[edge ^ 1] = 0
+                self.dead_edges += 2
+            edge = self.next_edge[edge]
+        if removed:
+            self.version += 1
+            if self.dead_edges > 1024 and 2*self.dead_edges > len(self.alive):
+                self.compact()
+            if self.counters.enabled:
+                self.counters.count(("remove_neighbor", "edges removed"),
+                        2*len(removed))
+        return removed
+
+    def remove_edges_to(self, face, others):
+        # remove_edges for every face in others with one pass over the
+        # edges of face, returns (other, offset) pairs
+        removed = []
+        edge = self.head[face]
+        while edge != -1:
+            if self.alive[edge] and self.edge_face[edge] in others:
+                removed.append((self.edge_face[edge], self.offsets[edge]))
+                self.alive[edge] = 0
+                self.alive[edge ^ 1] = 0
+                self.dead_edges += 2
+            edge = self.next_edge[edge]
+        if removed:
+            self.version += 1
+        return removed
+
+    def degree(self, face):
+        # length of the edge list of face, dead edges included
+        length = 0
+        edge = self.head[face]
+        while edge != -1:
+            length += 1
+            edge = self.next_edge[edge]
+        return length
+
+    def depth(self, face):
+        # steps from face to the root of its disjoint-set
+        depth = 0
+        while self.parent[face] != face:
+            face = self.parent[face]
+            depth += 1
+        return depth
+
+    def edges(self, face):
+        edge = self.head[face]
+        while edge != -1:
+            if self.alive[edge]:
+                yield self.edge_face[edge], self.offsets[edge]
+            edge = self.next_edge[edge]
+
+    def exact_neighbors(self, face):
+        return [neighbor for neighbor, offset in self.edges(face)
+                if not isinstance(offset, DistanceConstraint)]
+
+    def compact(self):
+        if self.counters.enabled:
+            self.counters.count(("compact", "edges rewritten"),
+                    len(self.alive) - self.dead_edges)
+        pairs = [(self.edge_face[edge + 1], self.edge_face[edge],
+                    self.parameters.get(edge, self.offsets[edge]))
+                for edge in range(0, len(self.alive), 2) if self.alive[edge]]
+        self.head = array.array('l', [-1])*len(self.faces)
+        self.tail = array.array('l', [-1])*len(self.faces)
+        self.edge_face = array.array('l')
+        self.next_edge = array.array('l')
+        self.alive = bytearray()
+        self.offsets = Numbers()
+        self.dead_edges = 0
+        self.parameters = {}
+        for face_0, face_1, offset in pairs:
+            if isinstance(offset, Parameter):
+                self.parameters[len(self.edge_face)] = offset
+                offset = offset.value
+            self.append_half_edge(face_0, face_1, offset)
+            self.append_half_edge(face_1, face_0, -offset)
+
+    def csr(self):
+        # Exact binds in compressed sparse row form: the neighbors of face i
+        # are indices[indptr[i]:indptr[i + 1]], in the order of binding.
+        if self.csr_cache is not None and self.csr_cache[0] == self.version:
+            return self.csr_cache[1]
+        indptr = array.array('l', [0])
+        indices = array.array('l')
+        offsets = []
+        edge_face, next_edge, alive = self.edge_face, self.next_edge, self.alive
+        edge_offsets = self.offsets.tolist()
+        for edge in self.head:
+            while edge != -1:
+                offset = edge_offsets[edge]
+                if alive[edge] and not isinstance(offset, DistanceConstraint):
+                    indices.append(edge_face[edge])
+                    offsets.append(offset)
+                edge = next_edge[edge]
+            indptr.append(len(indices))
+        self.csr_cache = (self.version, (indptr, indices, offsets))
+        return indptr, indices, offsets
+
+    def snapshot(self):
+        # The exact binds as NumPy arrays in the same compressed sparse
+        # row form as csr(), plus the disjoint-set root of every face.
+        # Offsets are stored as floats with a mask of the ones that were
+        # Python floats, so that solved positions keep their types. Returns
+        # None if there are offsets of other types.
+        import numpy
+
+        if (self.snapshot_cache is not None
+                and self.snapshot_cache[0] == self.version):
+            return self.snapshot_cache[1]
+        offsets = numpy.frombuffer(self.offsets.values, dtype=numpy.float64)
+        kinds = numpy.frombuffer(self.offsets.kinds, dtype=numpy.uint8)
+        is_float = kinds == Numbers.FLOAT
+        exact = numpy.frombuffer(self.alive, dtype=numpy.uint8).astype(bool)
+        for edge, offset in self.offsets.objects.items():
+            if isinstance(offset, DistanceConstraint):
+                exact[edge] = False
+            elif exact[edge]:
+                self.snapshot_cache = (self.version, None)
+                return None
+
+        edges = numpy.flatnonzero(exact)
+        edge_face = numpy.array(self.edge_face, dtype=numpy.int64)
+        sources = edge_face[edges ^ 1]
+        edges = edges[numpy.argsort(sources, kind="stable")]
+        indptr = numpy.zeros(len(self.faces) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(sources, minlength=len(self.faces)),
+                out=indptr[1:])
+
+        roots = numpy.array(self.parent, dtype=numpy.int64)
+        while True:
+            parents = roots[roots]
+            if numpy.array_equal(parents, roots):
+                break
+            roots = parents
+
+        snapshot = {
+            "indptr": indptr,
+            "indices": edge_face[edges],
+            "offsets": offsets[edges],
+            "is_float": is_float[edges],
+            "roots": roots,
+        }
+        self.snapshot_cache = (self.version, snapshot)
+        return snapshot
+
+    def find(self, face):
+        parent = self.parent
+        if parent[face] == face:
+            return face, 0
+        path = []
+        while parent[face] != face:
+            path.append(face)
+            face = parent[face]
+        offset = 0
+        for path_face in reversed(path):
+            offset += self.parent_offset[path_face]
+            parent[path_face] = face
+            self.parent_offset[path_face] = offset
+        return face, offset
+
+    def union(self, face_0, face_1, offset):
+        root_0, offset_0 = self.find(face_0)
+        root_1, offset_1 = self.find(face_1)
+        if root_0 == root_1:
+            # the faces are already bound, keep the existing offsets
+            return offset_1 - offset_0 == offset
+        root_offset = offset_0 + offset - offset_1
+        if self.bounds is not None:
+            self.bounds.invalidate()
+        self.generation += 1
+        if self.rank[root_0] < self.rank[root_1]:
+            self.parent[root_0] = root_1
+            self.parent_offset[root_0] = -root_offset
+            self.generations[root_1] = self.generation
+        else:
+            self.parent[root_1] = root_0
+            self.parent_offset[root_1] = root_offset
+            self.generations[root_0] = self.generation
+            if self.rank[root_0] == self.rank[root_1]:
+                self.rank[root_0] += 1
+        return True
+
+    def rebuild_set(self, *faces):
+        # Disjoint sets can't be split, so after an exact bind is removed
+        # the faces still reachable from its ends are collected and rejoined.
+        members = set(faces)
+        leave_faces = list(faces)
+        while leave_faces:
+            for neighbor in self.exact_neighbors(leave_faces.pop()):
+                if neighbor not in members:
+                    members.add(neighbor)
+                    leave_faces.append(neighbor)
+
+        if self.bounds is not None:
+            self.bounds.invalidate()
+        if self.counters.enabled:
+            self.counters.count(("rebuild_set", "calls"))
+            self.counters.count(("rebuild_set", "faces rewritten"), len(members))
+        self.generation += 1
+        for face in members:
+            self.parent[face] = face
+            self.parent_offset[face] = 0
+            self.rank[face] = 0
+            self.generations[face] = self.generation
+        for face in members:
+            for neighbor, offset in self.edges(face):
+                if not isinstance(offset, DistanceConstraint):
+                    self.union(face, neighbor, offset)
+
+    def merge(self, other):
+        # Moves the faces and binds of other into this graph, the handles
+        # of the moved faces are updated in place.
+        base = len(self.faces)
+        for face in other.faces:
+            face.graph = self
+            face.id += base
+        self.faces.extend(other.faces)
+        self.head.extend(array.array('l', [-1])*len(other.faces))
+        self.tail.extend(array.array('l', [-1])*len(other.faces))
+        self.s.extend(other.s)
+        self.parent.extend(parent + base for parent in other.parent)
+        self.parent_offset.extend(other.parent_offset)
+        self.rank.extend(other.rank)
+        self.generations.extend(array.array('l', [0])*len(other.faces))
+        for edge in range(0, len(other.alive), 2):
+            if other.alive[edge]:
+                self.add_edge(
+                        other.edge_face[edge + 1] + base,
+                        other.edge_face[edge] + base,
+                        other.parameters.get(edge, other.offsets[edge]))
+        if self.bounds is not None:
+            self.bounds.invalidate()
+        return other.faces
+
+    @staticmethod
+    def join(face_0, face_1):
+        graph_0 = face_0.graph
+        graph_1 = face_1.graph
+        if graph_0 is graph_1:
+            return graph_0
+        if graph_0.system is not None and graph_1.system is not None:
+            raise RuntimeError("Faces belong to different systems.")
+        if graph_1.system is not None or (graph_0.system is None
+                and len(graph_1.faces) > len(graph_0.faces)):
+            graph_0, graph_1 = graph_1, graph_0
+        moved_faces = graph_0.merge(graph_1)
+        if graph_0.system is not None:
+            graph_0.system.adopt(moved_faces)
+        return graph_0
+
+def partition_snapshot(snapshot, members):
+    # The part of a snapshot covering the faces in members (a whole
+    # disjoint-set, so no edge leaves it) with the faces renumbered.
+    import numpy
+
+    indptr = snapshot["indptr"]
+    local = numpy.full(len(indptr) - 1, -1, dtype=numpy.int64)
+    local[members] = numpy.arange(len(members))
+    degrees = indptr[members + 1] - indptr[members]
+    edges = edge_ranges(indptr[members], degrees)
+    local_indptr = numpy.zeros(len(members) + 1, dtype=numpy.int64)
+    numpy.cumsum(degrees, out=local_indptr[1:])
+    return {
+        "indptr": local_indptr,
+        "indices": local[snapshot["indices"][edges]],
+        "offsets": snapshot["offsets"][edges],
+        "is_float": snapshot["is_float"][edges],
+    }
+
+def edge_ranges(starts, counts):
+    # concatenated ranges starts[i]..starts[i] + counts[i]
+    import numpy
+
+    total = int(counts.sum())
+    ends = numpy.cumsum(counts)
+    return (numpy.arange(total) - numpy.repeat(ends - counts, counts)
+            + numpy.repeat(starts, counts))
+
+def solve_partition(partition, seeds, seed_values, seed_is_float):
+    # Breadth-first solve of a partition level by level with NumPy. When
+    # several faces of a level reach the same face, the first edge in
+    # the order of solve_dimension wins, so the results are the same.
+    # Returns masks of the solved faces and the float positions and the
+    # positions themselves.
+    import numpy
+
+    indptr = partition["indptr"]
+    indices = partition["indices"]
+    count = len(indptr) - 1
+    solved = numpy.zeros(count, dtype=bool)
+    s = numpy.zeros(count, dtype=numpy.float64)
+    is_float = numpy.zeros(count, dtype=bool)
+    leave_faces = numpy.asarray(seeds, dtype=numpy.int64)
+    solved[leave_faces] = True
+    s[leave_faces] = seed_values
+    is_float[leave_faces] = seed_is_float
+    while len(leave_faces):
+        degrees = indptr[leave_faces + 1] - indptr[leave_faces]
+        edges = edge_ranges(indptr[leave_faces], degrees)
+        sources = numpy.repeat(leave_faces, degrees)
+        targets = indices[edges]
+        new = ~solved[targets]
+        edges, sources, targets = edges[new], sources[new], targets[new]
+        first = numpy.sort(numpy.unique(targets, return_index=True)[1])
+        edges, sources, targets = edges[first], sources[first], targets[first]
+        s[targets] = s[sources] + partition["offsets"][edges]
+        is_float[targets] = is_float[sources] | partition["is_float"][edges]
+        solved[targets] = True
+        leave_faces = targets
+    return solved, is_float, s
+
+class DeferredBind:
+    def __init__(self, closure, face_pairs, system=None):
+        self.closure = closure
+        self.face_pairs = face_pairs
+        self.roots = ()
+        self.exception = None
+        self.system = system
+        # blocks added by the closure belong to the assemblies it was
+        # deferred in, not to the ones being built when it fires
+        self.assemblies = list(system.assemblies) if system else []
+
+    def run(self):
+        if self.system is None:
+            self.closure()
+            return
+        assemblies = self.system.assemblies
+        self.system.assemblies = self.assemblies
+        try:
+            self.closure()
+        finally:
+            self.system.assemblies = assemblies
+
+    def waiting_pair(self):
+        return next((pair for pair in self.face_pairs
+            if not pair[0].is_connected(pair[1])), None)
+
+    def __repr__(self):
+        name = getattr(self.closure, "__qualname__", repr(self.closure))
+        if self.exception is not None:
+            return "<DeferredBind {} failed: {!r}>".format(
+                    name, self.exception)
+        return "<DeferredBind {} waiting>".format(name)
+
+class DeferredBinds:
+    # Binds that can only be made once the distances between some faces are
+    # known. A deferred bind waits on the disjoint-set roots of its first
+    # face pair that isn't connected yet, and it is fired right after the
+    # bind that connects all of its pairs.
+    def __init__(self):
+        # root face: {DeferredBind: None}
+        self.waiting = {}
+        self.ready = collections.deque()
+        self.failed = []
+        self.firing = False
+
+    def add(self, deferred):
+        self.wait(deferred)
+        self.fire()
+
+    def wait(self, deferred):
+        for root in deferred.roots:
+            root_waiting = self.waiting.get(root)
+            if root_waiting is not None:
+                root_waiting.pop(deferred, None)
+                if not root_waiting:
+                    del self.waiting[root]
+
+        pair = deferred.waiting_pair()
+        if pair is None:
+            deferred.roots = ()
+            self.ready.append(deferred)
+        else:
+            deferred.roots = tuple(face.find()[0] for face in pair)
+            for root in deferred.roots:
+                self.waiting.setdefault(root, {})[deferred] = None
+
+    def connected(self, *roots):
+        deferreds = dict.fromkeys(deferred
+                for root in roots for deferred in self.waiting.get(root, ()))
+        for deferred in deferreds:
+            self.wait(deferred)
+        self.fire()
+
+    def reindex(self):
+        deferreds = dict.fromkeys(deferred
+                for root_waiting in self.waiting.values()
+                for deferred in root_waiting)
+        self.waiting = {}
+        for deferred in deferreds:
+            deferred.roots = ()
+            self.wait(deferred)
+        self.fire()
+
+    def fire(self):
+        if self.firing:
+            return
+        self.firing = True
+        try:
+            while self.ready:
+                deferred = self.ready.popleft()
+                try:
+                    deferred.run()
+                except Exception as e:
+                    deferred.exception = e
+                    self.failed.append(deferred)
+        finally:
+            self.firing = False
+
+    def unsatisfied(self):
+        return self.failed + list(dict.fromkeys(deferred
+                for root_waiting in self.waiting.values()
+                for deferred in root_waiting))
+
+class BindBatch:
+    # Binds and unbinds collected by ConstraintSystem.batch() and applied
+    # together when it ends: the bind lists are scanned once per face, the
+    # disjoint-sets split by unbinds are rebuilt once and waiting deferred
+    # binds are checked once. Only the last bind of a face pair counts,
+    # binding a pair again with another offset is a conflict, as is a bind
+    # that doesn't agree with the exact binds around it, within the same
+    # tolerance as find_conflicts(). Nothing is applied if there are
+    # conflicts.
+    unbind = object()
+
+    def __init__(self, system, tolerance=1e-6):
+        self.system = system
+        self.tolerance = tolerance
+        # (face_0, face_1): offset or BindBatch.unbind
+        self.operations = {}
+        # (face_0, face_1, offset, previous offset)
+        self.conflicts = []
+
+    def bind(self, face_0, face_1, offset):
+        key = (face_0, face_1)
+        if (face_1, face_0) in self.operations:
+            key = (face_1, face_0)
+            offset = -offset
+        previous = self.operations.get(key)
+        if (previous is not None and previous is not BindBatch.unbind
+                and not same_offset(previous, offset, self.tolerance)):
+            self.conflicts.append((*key, offset, previous))
+        self.operations[key] = offset
+
+    def unbind(self, face_0, face_1):
+        if (face_1, face_0) in self.operations:
+            self.operations[(face_1, face_0)] = BindBatch.unbind
+        else:
+            self.operations[(face_0, face_1)] = BindBatch.unbind
+
+    def commit(self):
+        report = ConflictReport(self.system)
+        if self.conflicts:
+            block_faces = report.get_block_faces()
+            raise ConstraintConflictException("Conflicting binds in batch:\n"
+                    + "\n".join("{} to {}: {} and {}".format(
+                        report.describe_face(face_0, block_faces),
+                        report.describe_face(face_1, block_faces),
+                        describe_offset(offset), describe_offset(previous))
+                        for face_0, face_1, offset, previous
+                        in self.conflicts))
+
+        # Every pair loses its old binds, the same way bind_faces unbinds
+        # the faces before binding them.
+        removed = self.remove_binds()
+        binds = [(face_0, face_1, offset)
+                for (face_0, face_1), offset in self.operations.items()
+                if offset is not BindBatch.unbind]
+        report.conflicts = [(face_0.normal_dimension, face_0, face_1, offset,
+                    distance)
+                for face_0, face_1, offset, distance in self.check(binds)]
+        if report:
+            for face_0, face_1, offset in removed:
+                self.add_bind(face_0, face_1, offset)
+            raise ConstraintConflictException(
+                    "Batched binds contradict exact binds:\n"
+                    + report.format())
+
+        roots = []
+        for face_0, face_1, offset in binds:
+            roots.extend(self.add_bind(face_0, face_1, offset))
+        if roots and self.system.deferred.waiting:
+            self.system.deferred.connected(*roots)
+
+    def remove_binds(self):
+        partners = {}
+        for face_0, face_1 in self.operations:
+            if face_0.graph is face_1.graph:
+                partners.setdefault(face_0, set()).add(face_1.id)
+
+        removed = []
+        split_faces = {}
+        for face, others in partners.items():
+            graph = face.graph
+            for other, offset in graph.remove_edges_to(face.id, others):
+                other = graph.faces[other]
+                removed.append((face, other, offset))
+                if isinstance(offset, DistanceConstraint):
+                    graph.bounds.remove(face, other)
+                else:
+                    graph.touch(face.id)
+                    graph.touch(other.id)
+                    split_faces.setdefault(graph, []).extend((face, other))
+            if graph.counters.enabled:
+                graph.counters.count(("remove_neighbor", "calls"))
+        for graph, faces in split_faces.items():
+            if graph.dead_edges > 1024 and 2*graph.dead_edges > len(graph.alive):
+                graph.compact()
+            Face.rebuild_set(*faces)
+        return removed
+
+    def check(self, binds):
+        # Exact binds are joined on top of the current disjoint-sets
+        # without touching them, returns (face_0, face_1, offset, distance)
+        # for the binds that contradict the ones before them.
+        parent = {}
+
+        def find(face):
+            root, offset = face.graph.find(face.id)
+            root = (face.graph, root)
+            while root in parent:
+                root, root_offset = parent[root]
+                offset += root_offset
+            return root, offset
+
+        conflicts = []
+        for face_0, face_1, offset in binds:
+            if isinstance(offset, DistanceConstraint):
+                continue
+            root_0, offset_0 = find(face_0)
+            root_1, offset_1 = find(face_1)
+            if root_0 != root_1:
+                parent[root_1] = (root_0, offset_0 + offset - offset_1)
+            elif abs(offset_1 - offset_0 - offset) > self.tolerance:
+                conflicts.append(
+                        (face_0, face_1, offset, offset_1 - offset_0))
+        return conflicts
+
+    def add_bind(self, face_0, face_1, offset):
+        # returns the roots of the sets joined by the bind
+        graph = face_0.graph
+        offset = graph.add_edge(face_0.id, face_1.id, offset)
+        if graph.counters.enabled:
+            graph.counters.count(("bind_faces", "calls"))
+            graph.counters.count(("bind_faces", "edges written"), 2)
+        if isinstance(offset, DistanceConstraint):
+            graph.bounds.add(face_0, face_1, offset)
+            return ()
+        graph.touch(face_0.id)
+        graph.touch(face_1.id)
+        root_0 = graph.find(face_0.id)[0]
+        root_1 = graph.find(face_1.id)[0]
+        graph.union(face_0.id, face_1.id, offset)
+        if root_0 == root_1:
+            return ()
+        return graph.faces[root_0], graph.faces[root_1]
+
+def same_offset(offset_0, offset_1, tolerance=0):
+    if isinstance(offset_0, DistanceConstraint):
+        return (isinstance(offset_1, DistanceConstraint)
+                and offset_0.equality == offset_1.equality
+                and abs(offset_0.value - offset_1.value) <= tolerance)
+    return (not isinstance(offset_1, DistanceConstraint)
+            and abs(offset_0 - offset_1) <= tolerance)
+
+def describe_offset(offset):
+    if isinstance(offset, DistanceConstraint):
+        return "{} {}".format(offset.equality.name, offset.value)
+    return str(offset)
+
+def describe_face(face):
+    return "<Face {} {}>".format(face.normal_dimension.name, face.id)
+
+class UnderconstrainedReport:
+    # Faces and blocks that aren't bound to origo, so solving can't give
+    # them a position. Faces that no block uses are usually helpers such as
+    # offset copies of normals and rarely matter, blocks always do.
     def __init__(self):
+        # dimension: [Face]
+        self.faces = {dimension: [] for dimension in Dimension}
+        # block: [Dimension]
+        self.blocks = {}
+
+    def __bool__(self):
+        return bool(self.blocks)
+
+    def format(self):
+        lines = []
+        for block, dimensions in self.blocks.items():
+            lines.append("Underdefined in {}: {}".format(
+                ", ".join(dimension.name for dimension in dimensions),
+                block.describe().rstrip()))
+        return "\n".join(lines)
+
+class ConflictReport:
+    # Binds that disagree with the exact binds of the same disjoint-set:
+    # every one closes a cycle whose offsets don't sum to zero, or is an
+    # inequality the exact binds break.
+    def __init__(self, system):
+        self.system = system
+        # (dimension, face_0, face_1, offset, distance): offset is the bind
+        # and distance is s(face_1) - s(face_0) given by the other binds
+        self.conflicts = []
+
+    def __bool__(self):
+        return bool(self.conflicts)
+
+    def describe_face(self, face, block_faces):
+        block, sign = block_faces.get(face, (None, None))
+        if block is None:
+            return describe_face(face)
+        name = getattr(block, "name", None)
+        if name is None:
+            name = " ".join(filter(None, (type(block).__name__,
+                getattr(block, "material", None))))
+        return "{} {} {}".format(
+                name, "high" if sign else "low", face.normal_dimension.name)
+
+    def get_block_faces(self):
+        # face: (block, 0 for the low face and 1 for the high one)
+        return {face: (block, sign) for block in self.system.blocks
+                for face_pair in block.faces.values()
+                for sign, face in enumerate(face_pair)}
+
+    def format(self):
+        block_faces = self.get_block_faces()
+        lines = []
+        for dimension, face_0, face_1, offset, distance in self.conflicts:
+            lines.append("{} to {}: bound {}, other binds give {}".format(
+                self.describe_face(face_0, block_faces),
+                self.describe_face(face_1, block_faces),
+                describe_offset(offset), describe_offset(distance)))
+            lines.extend(line.rstrip("\n") for line
+                    in self.system.provenance.format_bind(face_0, face_1))
+        return "\n".join(lines)
+
+class Provenance:
+    # Where blocks and binds were made. Capturing only keeps code objects
+    # and line numbers, the source lines are looked up when a diagnostic is
+    # formatted. Disabled by default as even that isn't free.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        # (face_0, face_1): captured stack of the latest bind
+        self.binds = {}
+
+    def capture(self, skip=1):
+        if not self.enabled:
+            return None
+        frame = sys._getframe(skip + 1)
+        stack = []
+        while frame is not None:
+            stack.append((frame.f_code, frame.f_lineno))
+            frame = frame.f_back
+        return stack
+
+    def capture_bind(self, face_0, face_1):
+        if self.enabled:
+            self.binds.pop((face_1, face_0), None)
+            self.binds[(face_0, face_1)] = self.capture(2)
+
+    def get_bind(self, face_0, face_1):
+        return self.binds.get((face_0, face_1),
+                self.binds.get((face_1, face_0)))
+
+    @staticmethod
+    def format(stack):
+        if stack is None:
+            return []
+        import traceback
+        return traceback.format_list(traceback.StackSummary.from_list(
+                [(code.co_filename, lineno, code.co_name, None)
+                    for code, lineno in reversed(stack)]))
+
+    def format_bind(self, face_0, face_1):
+        return Provenance.format(self.get_bind(face_0, face_1))
+
+class ConstraintSystem:
+    def __init__(self, provenance=False, stats=False):
+        self.provenance = Provenance(provenance)
+        self.counters = Stats(stats)
         self.blocks = []
+        # placed templates, see template.py
+        self.instances = []
+        self.graphs = {dimension: FaceGraph(dimension, self)
+                for dimension in Dimension}
+        self.bounds = {dimension: graph.bounds
+                for dimension, graph in self.graphs.items()}
+        self.solved = False
+        # graph versions at the last solve, see geometry_current()
+        self.solved_versions = None
+        # dimension: {root: (generation, position of the root)}
+        self.root_positions = {dimension: {} for dimension in Dimension}
+        self.spatial_index = None
+        self.indexed_blocks = set()
+        self.deferred = DeferredBinds()
+        self.transaction = None
+        # names of the assemblies being built, see assembly()
+        self.assemblies = []
 
         self.origo = ConstrainedBlock(self)
         for face in (f for f_pair in self.origo.faces.values() for f in f_pair):
             face.s = 0
 
     def add(self, block):
+        if self.assemblies:
+            block.assembly = tuple(self.assemblies)
         self.blocks.append(block)
 
+    def placed_blocks(self):
+        # The blocks of the placed templates. They are not in blocks or in
+        # the face graphs, only exports and cut lists include them.
+        for instance in self.instances:
+            yield from instance.get_placed_blocks()
+
+    def enable_stats(self, enabled=True):
+        self.counters.enable(enabled)
+
+    def stats(self, reset=False):
+        # Counters collected since the last reset as nested dicts. Reset
+        # between phases to see where the time of each one goes.
+        result = self.counters.as_dict()
+        if reset:
+            self.reset_stats()
+        return result
+
+    def reset_stats(self):
+        self.counters.reset()
+
+    def defer(self, closure, *face_pairs):
+        self.deferred.add(DeferredBind(closure, face_pairs, self))
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Binds and unbinds between faces of this system made inside the
+        # with block are collected and applied when it ends, see BindBatch.
+        # Distances read inside the block don't see them yet. Nested
+        # batches are part of the outermost one.
+        if self.transaction is not None:
+            yield self.transaction
+            return
+        self.transaction = BindBatch(self)
+        try:
+            yield self.transaction
+        except BaseException:
+            self.transaction = None
+            raise
+        transaction = self.transaction
+        self.transaction = None
+        transaction.commit()
+
+    @contextlib.contextmanager
+    def assembly(self, name):
+        # Blocks added inside the with block get the names of this and the
+        # enclosing assemblies as their assembly attribute, part exports
+        # write a file per assembly.
+        self.assemblies.append(name)
+        try:
+            yield
+        finally:
+            self.assemblies.pop()
+
+    def find_underconstrained(self):
+        # One pass over the faces of every dimension: a face is connected
+        # to origo if it is in the disjoint-set of an origo face.
+        report = UnderconstrainedReport()
+        for dimension, graph in self.graphs.items():
+            origo_roots = {graph.find(face.id)[0]
+                    for face in self.origo.faces[dimension]}
+            connected = bytearray(len(graph.faces))
+            for face in range(len(graph.faces)):
+                if graph.find(face)[0] in origo_roots:
+                    connected[face] = 1
+                else:
+                    report.faces[dimension].append(graph.faces[face])
+            for block in self.blocks:
+                if not all(face.graph is graph and connected[face.id]
+                        for face in block.faces[dimension]):
+                    report.blocks.setdefault(block, []).append(dimension)
+        return report
+
+    def find_conflicts(self, tolerance=1e-6):
+        # Positions relative to a spanning forest of the exact binds are
+        # found by one breadth-first pass per dimension, then every bind is
+        # checked against them. Binds of the forest hold by definition, so
+        # each conflict is a bind closing an inconsistent cycle.
+        report = ConflictReport(self)
+        for dimension, graph in self.graphs.items():
+            indptr, indices, offsets = graph.csr()
+            s = [None]*len(graph.faces)
+            # first face of the tree each face is in
+            trees = [None]*len(graph.faces)
+            for start in range(len(graph.faces)):
+                if s[start] is not None:
+                    continue
+                s[start] = 0
+                trees[start] = start
+                leave_faces = [start]
+                while leave_faces:
+                    face = leave_faces.pop()
+                    for edge in range(indptr[face], indptr[face + 1]):
+                        neighbor = indices[edge]
+                        if s[neighbor] is None:
+                            s[neighbor] = s[face] + offsets[edge]
+                            trees[neighbor] = start
+                            leave_faces.append(neighbor)
+
+            for edge in range(0, len(graph.alive), 2):
+                if not graph.alive[edge]:
+                    continue
+                face_0 = graph.edge_face[edge + 1]
+                face_1 = graph.edge_face[edge]
+                offset = graph.offsets[edge]
+                distance = s[face_1] - s[face_0]
+                if isinstance(offset, DistanceConstraint):
+                    if trees[face_0] != trees[face_1]:
+                        continue
+                    if offset.equality == Equality.GT:
+                        consistent = distance >= offset.value - tolerance
+                    elif offset.equality == Equality.LT:
+                        consistent = distance <= offset.value + tolerance
+                    else:
+                        consistent = abs(distance - offset.value) <= tolerance
+                else:
+                    consistent = abs(distance - offset) <= tolerance
+                if not consistent:
+                    report.conflicts.append((dimension, graph.faces[face_0],
+                        graph.faces[face_1], offset, distance))
+        return report
+
+    def compile(self):
+        # Linear map from the Parameters used as bind offsets to the
+        # positions of the faces, see linear_map.py.
+        import linear_map
+        return linear_map.compile_system(self)
+
+    def unsatisfied_binds(self):
+        return self.deferred.unsatisfied()
+
+    def adopt(self, faces):
+        # Faces created without a system join the system of the first
+        # face they are bound to, along with everything bound to them.
+        for face in faces:
+            face.graph.touch(face.id)
+            for neighbor_face, offset in face.neighbors:
+                if (isinstance(offset, DistanceConstraint)
+                        and face.id < neighbor_face.id):
+                    face.graph.bounds.add(face, neighbor_face, offset)
+        # Binds between free faces don't tell the deferred binds about the
+        # sets they join, so the ones waiting on moved faces are checked
+        # again now.
+        if self.deferred.waiting:
+            self.deferred.connected(*faces)
+
+    def geometry_current(self):
+        # True if nothing was bound or unbound since the last solve, so the
+        # solved positions and the spatial index can be trusted
+        return self.solved and self.solved_versions == tuple(
+                graph.version for graph in self.graphs.values())
+
     def make_hole(self, hole_block, target_blocks=[]):
-        if not target_blocks:
-            target_blocks = self.blocks
-        for t_block in target_blocks:
-            if hole_block.intersects(t_block):
+        extent = hole_block.get_extent() if self.geometry_current() else None
+        if extent is None:
+            for t_block in target_blocks or self.blocks:
+                if (t_block is not hole_block
+                        and hole_block.intersects(t_block)):
+                    t_block.make_hole(hole_block)
+            return
+
+        candidates = self.query_box(*extent)
+        if target_blocks:
+            candidates = set(candidates)
+            candidates = [t_block for t_block in target_blocks
+                    if t_block in candidates
+                    or (t_block not in self.indexed_blocks
+                        and hole_block.intersects(t_block))]
+        for t_block in candidates:
+            if t_block is not hole_block:
                 t_block.make_hole(hole_block)
 
-    def solve(self):
+    def get_spatial_index(self):
+        # Solved extents of the blocks, rebuilt on the first query after
+        # a solve. Blocks that aren't fully solved are left out. Binds
+        # made after the solve aren't seen, see geometry_current().
+        if self.spatial_index is None:
+            extents = [(block.get_extent(), block) for block in self.blocks]
+            extents = [(extent, block) for extent, block in extents
+                    if extent is not None]
+            self.spatial_index = SpatialIndex(
+                    [extent for extent, block in extents],
+                    [block for extent, block in extents])
+            self.indexed_blocks = set(self.spatial_index.items)
+        return self.spatial_index
+
+    def query_box(self, low, high):
+        return self.get_spatial_index().query(low, high)
+
+    def query_block(self, block):
+        extent = block.get_extent()
+        if extent is None:
+            return []
+        return [other for other in self.query_box(*extent)
+                if other is not block]
+
+    def solved_geometry(self, blocks=None):
+        # Origins (low faces) and extents (high - low) of blocks as a NumPy
+        # structured array, NaN where a face isn't solved.
+        import numpy
+
+        if blocks is None:
+            blocks = self.blocks
+        geometry = numpy.zeros(len(blocks), dtype=[
+                ("index", "i8"),
+                ("origin", "f8", 3),
+                ("extent", "f8", 3),
+                ("material", "U16"),
+                ("visible", "?"),
+                ("length_dimension", "i1"),
+                ])
+        geometry["index"] = numpy.arange(len(blocks))
+        for axis, dimension in enumerate(Dimension):
+            graph = self.graphs[dimension]
+            # None is NaN in the values already
+            s = numpy.array(graph.s.values, dtype="f8")
+            for face, position in graph.s.objects.items():
+                s[face] = position
+            faces = [block.faces[dimension] for block in blocks]
+            if all(low.graph is graph and high.graph is graph
+                    for low, high in faces):
+                low = s[numpy.fromiter((low.id for low, high in faces),
+                    "i8", len(faces))]
+                high = s[numpy.fromiter((high.id for low, high in faces),
+                    "i8", len(faces))]
+            else:
+                low, high = (numpy.array(
+                    [getattr(face, "s", None) for face in side], dtype="f8")
+                    for side in zip(*faces))
+            geometry["origin"][:, axis] = low
+            geometry["extent"][:, axis] = high - low
+
+        dimensions = list(Dimension)
+        geometry["material"] = [
+                getattr(block, "material", "") for block in blocks]
+        geometry["visible"] = [
+                getattr(block, "visible", True) for block in blocks]
+        geometry["length_dimension"] = [
+                dimensions.index(block.length_dimension)
+                if getattr(block, "length_dimension", None) is not None
+                else -1
+                for block in blocks]
+        return geometry
+
+    def solve(self, incremental=False, parallel=False, processes=None):
+        self.spatial_index = None
+        if incremental and self.solved:
+            for dimension in Dimension:
+                self.solve_touched(dimension)
+        elif not (parallel and self.solve_parallel(processes)):
+            for dimension in Dimension:
+                self.solve_dimension(dimension)
+        self.solved = True
+        self.solved_versions = tuple(
+                graph.version for graph in self.graphs.values())
+
+    def solve_parallel(self, processes=None):
+        # Every disjoint-set holding an origo face of a dimension is solved
+        # as its own partition in a process pool, the rest of the faces
+        # can't be reached from origo and stay unsolved. Returns False
+        # without solving anything if some offsets can't be snapshotted.
+        # With one process the partitions are solved in this one, the
+        # vectorized solve is faster than solve_dimension even then.
+        import os
+        import numpy
+        import concurrent.futures
+
+        snapshots = {dimension: self.graphs[dimension].snapshot()
+                for dimension in Dimension}
+        if any(snapshot is None for snapshot in snapshots.values()):
+            return False
+
+        jobs = []
+        for dimension, snapshot in snapshots.items():
+            graph = self.graphs[dimension]
+            seeds = {}
+            for face in self.origo.faces[dimension]:
+                seeds.setdefault(snapshot["roots"][face.id], []).append(face.id)
+            for root, root_seeds in seeds.items():
+                members = numpy.flatnonzero(snapshot["roots"] == root)
+                local_seeds = numpy.searchsorted(members, root_seeds)
+                jobs.append((dimension, members, (
+                        partition_snapshot(snapshot, members), local_seeds,
+                        [graph.s[face] for face in root_seeds],
+                        [type(graph.s[face]) is float for face in root_seeds])))
+
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes == 1 or len(jobs) == 1:
+            results = [solve_partition(*job[2]) for job in jobs]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+                results = list(pool.map(solve_partition,
+                        *zip(*(job[2] for job in jobs))))
+
         for dimension in Dimension:
-            self.solve_dimension(dimension)
+            graph = self.graphs[dimension]
+            graph.s = Numbers.repeat(None, len(graph.faces))
+            graph.touched = array.array('l')
+        for (dimension, members, job), (solved, is_float, s) in zip(
+                jobs, results):
+            graph_s = self.graphs[dimension].s
+            for face, face_is_float, face_s in zip(members[solved].tolist(),
+                    is_float[solved].tolist(), s[solved].tolist()):
+                graph_s[face] = face_s if face_is_float else int(face_s)
+        return True
+
+    def solve_partial(self, items):
+        # Solves only the faces of the given blocks and faces: a face is
+        # placed by its offset from the root of its disjoint-set, and the
+        # root by the origo face in the set. The root positions are kept
+        # until the set changes, so the work is proportional to the number
+        # of faces asked for. The positions follow the disjoint-set instead
+        # of the tree of solve_dimension, so they only differ from a full
+        # solve where find_conflicts() reports conflicts, or in the last
+        # bits of float sums. Placed templates are always solved, exports
+        # include their boards.
+        self.spatial_index = None
+        for item in itertools.chain(items, self.instances):
+            if isinstance(item, Face):
+                faces = (item,)
+            else:
+                faces = (face for face_pair in item.faces.values()
+                        for face in face_pair)
+            for face in faces:
+                graph = face.graph
+                if graph.system is not self:
+                    continue
+                root, offset = graph.find(face.id)
+                root_position = self.get_root_position(graph, root)
+                graph.s[face.id] = (None if root_position is None
+                        else root_position + offset)
+
+    def get_root_position(self, graph, root):
+        # None if the set has no origo face
+        positions = self.root_positions[graph.dimension]
+        entry = positions.get(root)
+        if entry is not None and entry[0] == graph.generations[root]:
+            return entry[1]
+        position = None
+        for origo_face in self.origo.faces[graph.dimension]:
+            origo_root, origo_offset = graph.find(origo_face.id)
+            if origo_root == root:
+                position = graph.s[origo_face.id] - origo_offset
+                break
+        positions[root] = (graph.generations[root], position)
+        return position
 
     def solve_dimension(self, dimension: Dimension):
-        leave_faces = [
-                self.origo.faces[dimension][0],
-                self.origo.faces[dimension][1]]
+        graph = self.graphs[dimension]
+        indptr, indices, offsets = graph.csr()
+        s = [None]*len(graph.faces)
+        leave_faces = [face.id for face in self.origo.faces[dimension]]
+        for face in leave_faces:
+            s[face] = graph.s[face]
         while leave_faces:
             new_leave_faces = []
             for old_face in leave_faces:
-                for neighbor_face, offset in old_face.neighbors:
-                    if isinstance(offset, DistanceConstraint):
-                        continue
-                    neighbor_face.s = old_face.s + offset
-                    neighbor_face.neighbors[:]\
-                            = [p for p in neighbor_face.neighbors
-                                    if not p[0] == old_face]
-                    new_leave_faces.append(neighbor_face)
+                for edge in range(indptr[old_face], indptr[old_face + 1]):
+                    neighbor_face = indices[edge]
+                    if s[neighbor_face] is None:
+                        s[neighbor_face] = s[old_face] + offsets[edge]
+                        new_leave_faces.append(neighbor_face)
             leave_faces = new_leave_faces
+        graph.s = Numbers(s)
+        graph.touched = array.array('l')
+
+        if self.counters.enabled:
+            # Every solved face scans all its edges, the ones that didn't
+            # propagate a position lead to an already solved face.
+            solved = [face for face in range(len(s)) if s[face] is not None]
+            edges = sum(indptr[face + 1] - indptr[face] for face in solved)
+            propagated = len(solved) - len(self.origo.faces[dimension])
+            self.counters.count(("solve_dimension", dimension.name,
+                "faces propagated"), propagated)
+            self.counters.count(("solve_dimension", dimension.name,
+                "edges pruned"), edges - propagated)
+
+    def solve_touched(self, dimension: Dimension):
+        # Only faces whose position actually changes are visited, so the
+        # work is proportional to the part of the model that moved.
+        graph = self.graphs[dimension]
+        origo_faces = [face.id for face in self.origo.faces[dimension]]
+        anchors = [(graph.find(face), graph.s[face]) for face in origo_faces]
+        seen_faces = set(origo_faces)
+        leave_faces = list(graph.touched)
+        graph.touched = array.array('l')
+        while leave_faces:
+            face = leave_faces.pop()
+            if face in seen_faces:
+                continue
+            seen_faces.add(face)
+
+            root, offset = graph.find(face)
+            s = next((anchor_s + offset - anchor_offset
+                for (anchor_root, anchor_offset), anchor_s in anchors
+                if anchor_root == root), None)
+            if s is None:
+                if graph.s[face] is None:
+                    continue
+            elif graph.s[face] is not None and graph.s[face] == s:
+                continue
+            graph.s[face] = s
+            neighbors = graph.exact_neighbors(face)
+            leave_faces.extend(neighbors)
+            if self.counters.enabled:
+                self.counters.count(("solve_touched", dimension.name,
+                    "faces propagated"))
+                self.counters.count(("solve_touched", dimension.name,
+                    "edges scanned"), len(neighbors))
 
 class ConstrainedBlock:
-    def __init__(self, system: ConstraintSystem):
+    def __init__(self, system: ConstraintSystem, faces=None):
+        # faces: dimension: (low face, high face) of existing faces, new
+        # ones are made by default
         #system.add(self)
         self.system = system
-        self.faces = {
-                Dimension.X: (Face(Dimension.X), Face(Dimension.X)),
-                Dimension.Y: (Face(Dimension.Y), Face(Dimension.Y)),
-                Dimension.Z: (Face(Dimension.Z), Face(Dimension.Z)),
-                }
+        if faces is None:
+            faces = {dimension: (Face(dimension, system),
+                        Face(dimension, system))
+                    for dimension in Dimension}
+        self.faces = faces
         #for face_l, face_h in self.faces.values():
         #    face_l.bind(face_h, offset=DistanceConstraint(">", 0))
-        self.tb = traceback.format_stack()
+        self.origin = system.provenance.capture()
+
+    @property
+    def tb(self):
+        return Provenance.format(self.origin)
+
+    def describe(self):
+        description = getattr(self, "name", type(self).__name__)
+        if self.origin is not None:
+            description += ", created at:\n" + "".join(self.tb)
+        return description
 
     @staticmethod
     def from_faces(system, x0, x1, y0, y1, z0, z1):
-        new_block = ConstrainedBlock(system)
-        new_block.faces = {
+        return ConstrainedBlock(system, {
                 Dimension.X: (x0, x1),
                 Dimension.Y: (y0, y1),
                 Dimension.Z: (z0, z1),
-                }
-        return new_block
+                })
 
     @staticmethod
     def from_normals(system, *normals):
-        new_block = ConstrainedBlock(system)
+        faces = {dimension: [None, None] for dimension in Dimension}
         for a_normal in normals:
-            faces_tuple_as_list = list(new_block.faces[a_normal.dimension])
-            faces_tuple_as_list[1 if a_normal.is_positive else 0]\
+            faces[a_normal.dimension][1 if a_normal.is_positive else 0]\
                     = a_normal.face
-            new_block.faces[a_normal.dimension] = tuple(faces_tuple_as_list)
-        return new_block
+        # only the faces no normal gives are made
+        return ConstrainedBlock(system, {
+                dimension: tuple(face or Face(dimension, system)
+                    for face in face_pair)
+                for dimension, face_pair in faces.items()})
 
     def bind(
             self, other, dimension: Dimension,
@@ -176,11 +1685,10 @@ class ConstrainedBlock:
                     other.get_low_face(dimension),
                     difference)
 
-        try:
-            bind_closure()
-            return None
-        except:
-            return bind_closure
+        self.system.defer(
+                bind_closure,
+                self.faces[dimension],
+                other.faces[dimension])
 
     def bind_internally(self, dimension: Dimension, offset):
         faces = self.faces[dimension]
@@ -224,8 +1732,8 @@ class ConstrainedBlock:
         try:
             return self.faces[dimension][1].s - self.faces[dimension][0].s
         except AttributeError:
-            pdb.set_trace()
-            sys.exit("Something is underdefined.")
+            raise UnderconstrainedException("Underdefined in {}: {}".format(
+                dimension.name, self.describe().rstrip())) from None
 
     def get_internal_length(self, dimension: Dimension):
         try:
@@ -233,15 +1741,26 @@ class ConstrainedBlock:
                 if n[0] == self.faces[dimension][1]
                 and not isinstance(n[1], DistanceConstraint)))
         except IndexError:
-            pdb.set_trace()
+            import pdb; pdb.set_trace()
             sys.exit("No internal bind.")
 
     def get_position(self, dimension: Dimension):
         try:
             return self.faces[dimension][0].s
         except AttributeError:
-            pdb.set_trace()
-            sys.exit("Something is underdefined")
+            raise UnderconstrainedException("Underdefined in {}: {}".format(
+                dimension.name, self.describe().rstrip())) from None
+
+    def get_extent(self):
+        # solved bounding box as (low corner, high corner), None if some
+        # face isn't solved
+        try:
+            positions = [(self.faces[dimension][0].s, self.faces[dimension][1].s)
+                    for dimension in Dimension]
+        except AttributeError:
+            return None
+        return (tuple(min(p) for p in positions),
+                tuple(max(p) for p in positions))
 
     def intersects(self, other):
         for dimension in Dimension:
@@ -262,10 +1781,10 @@ class ConstrainedBlock:
         raise NotImplementedError
 
     def union(self, other):
-        the_union = ConstrainedBlock(self.system)
+        faces = {}
         try:
             for dimension in Dimension:
-                the_union.faces[dimension] = (
+                faces[dimension] = (
                         self.faces[dimension][0]
                         if self.faces[dimension][0].get_distance(
                             other.faces[dimension][0]) > 0
@@ -276,49 +1795,192 @@ class ConstrainedBlock:
                         else self.faces[dimension][1]
                         )
         except:
-            pdb.set_trace()
+            import pdb; pdb.set_trace()
             debug()
-        return the_union
+        return ConstrainedBlock(self.system, faces)
 
     def __add__(self, other):
         return self.union(other)
 
     
 class Face:
-    def __init__(self, normal_dimension: Dimension):
+    # When set, get_distance enumerates every simple path between the faces
+    # like it used to instead of using the disjoint-set offsets. Slow, but
+    # useful as a reference when debugging the faster lookups.
+    reference_search = False
+
+    __slots__ = ("graph", "id")
+
+    def __init__(self, normal_dimension: Dimension, system=None):
+        if system is not None:
+            self.graph = system.graphs[normal_dimension]
+        else:
+            self.graph = FaceGraph(normal_dimension)
+        self.id = self.graph.add_face(self)
+
+    @property
+    def normal_dimension(self):
+        return self.graph.dimension
+
+    @property
+    def system(self):
+        return self.graph.system
+
+    @property
+    def neighbors(self):
         # list of neighbor tuples: (neighbor, offset)
-        self.neighbors = []
-        self.normal_dimension = normal_dimension
+        return [(self.graph.faces[neighbor], offset)
+                for neighbor, offset in self.graph.edges(self.id)]
+
+    @property
+    def s(self):
+        s = self.graph.s[self.id]
+        if s is None:
+            raise AttributeError("Face has not been solved.")
+        return s
+
+    @s.setter
+    def s(self, s):
+        self.graph.s[self.id] = s
+
+    @s.deleter
+    def s(self):
+        self.graph.s[self.id] = None
 
     @staticmethod
     def bind_faces(face_0, face_1, offset = 0):
-        face_0.remove_neighbor(face_1)
-        face_1.remove_neighbor(face_0)
-        face_0.add_neighbor(face_1, offset)
-        face_1.add_neighbor(face_0, -offset)
+        graph = FaceGraph.join(face_0, face_1)
+        system = graph.system
+        if system is not None:
+            system.provenance.capture_bind(face_0, face_1)
+            if system.transaction is not None:
+                system.transaction.bind(face_0, face_1, offset)
+                return
+        Face.unbind_faces(face_0, face_1)
+        offset = graph.add_edge(face_0.id, face_1.id, offset)
+        if graph.counters.enabled:
+            graph.counters.count(("bind_faces", "calls"))
+            graph.counters.count(("bind_faces", "edges written"), 2)
+        if isinstance(offset, DistanceConstraint):
+            if system is not None:
+                graph.bounds.add(face_0, face_1, offset)
+        elif system is None:
+            graph.union(face_0.id, face_1.id, offset)
+        else:
+            graph.touch(face_0.id)
+            graph.touch(face_1.id)
+            if not system.deferred.waiting:
+                graph.union(face_0.id, face_1.id, offset)
+                return
+            root_0 = graph.find(face_0.id)[0]
+            root_1 = graph.find(face_1.id)[0]
+            graph.union(face_0.id, face_1.id, offset)
+            if root_0 != root_1:
+                system.deferred.connected(
+                        graph.faces[root_0], graph.faces[root_1])
 
     def unbind_faces(face_0, face_1):
-        face_0.remove_neighbor(face_1)
-        face_1.remove_neighbor(face_0)
+        if face_0.graph is not face_1.graph:
+            return
+        graph = face_0.graph
+        if graph.system is not None and graph.system.transaction is not None:
+            graph.system.transaction.unbind(face_0, face_1)
+            return
+        removed = face_0.remove_neighbor(face_1)
+        if (graph.bounds is not None
+                and any(isinstance(o, DistanceConstraint) for o in removed)):
+            graph.bounds.remove(face_0, face_1)
+        if any(not isinstance(o, DistanceConstraint) for o in removed):
+            graph.touch(face_0.id)
+            graph.touch(face_1.id)
+            Face.rebuild_set(face_0, face_1)
 
     def bind(self, other, offset = 0):
         Face.bind_faces(self, other, offset)
 
-    def add_neighbor(self, neighbor, offset):
-        self.neighbors.append((neighbor, offset))
-
     def remove_neighbor(self, neighbor):
-        self.neighbors[:] = [n for n in self.neighbors if not n[0] == neighbor]
+        if neighbor.graph is not self.graph:
+            return []
+        return self.graph.remove_edges(self.id, neighbor.id)
 
-    def remove_neighbor(self, neighbor):
-        self.neighbors[:] = [n for n in self.neighbors if not n[0] == neighbor]
+    def find(self):
+        root, offset = self.graph.find(self.id)
+        return self.graph.faces[root], offset
+
+    @staticmethod
+    def union(face_0, face_1, offset):
+        graph = FaceGraph.join(face_0, face_1)
+        return graph.union(face_0.id, face_1.id, offset)
+
+    @staticmethod
+    def rebuild_set(*faces):
+        graph = faces[0].graph
+        graph.rebuild_set(*(face.id for face in faces))
+        if graph.system is not None and graph.system.deferred.waiting:
+            graph.system.deferred.reindex()
+
+    def is_connected(self, other):
+        if self.graph is not other.graph:
+            return False
+        return self.graph.find(self.id)[0] == self.graph.find(other.id)[0]
 
     def get_distance(self, other):
+        stats = self.graph.counters
+        if stats.enabled:
+            stats.count(("get_distance", "calls"))
+        if self == other:
+            return 0
+        if Face.reference_search:
+            return self.search_distance(other)
+
+        if self.graph is other.graph:
+            if stats.enabled:
+                depth_self = self.graph.depth(self.id)
+                depth_other = self.graph.depth(other.id)
+                stats.count(("get_distance", "nodes visited"),
+                        depth_self + depth_other + 2)
+                stats.maximum(("get_distance", "max depth"),
+                        max(depth_self, depth_other))
+            root_self, offset_self = self.graph.find(self.id)
+            root_other, offset_other = self.graph.find(other.id)
+            if root_self == root_other:
+                if stats.enabled:
+                    stats.count(("get_distance", "candidates"))
+                return offset_other - offset_self
+        if self.system is None:
+            return self.search_distance(other)
+
+        lower, upper = self.get_bounds(other)
+        if stats.enabled:
+            stats.count(("get_distance", "bound lookups"))
+            if lower > -math.inf or upper < math.inf:
+                stats.count(("get_distance", "candidates"))
+        if lower == upper:
+            return lower
+        if lower > -math.inf:
+            return DistanceConstraint(">", lower)
+        if upper < math.inf:
+            return DistanceConstraint("<", upper)
+        raise DistanceNotConstrainedException
+
+    def get_bounds(self, other):
+        if self.graph is not other.graph or self.system is None:
+            if self.is_connected(other):
+                distance = self.get_distance(other)
+                return distance, distance
+            return -math.inf, math.inf
+        return self.graph.bounds.get_bounds(self, other)
+
+    def search_distance(self, other):
         if self == other:
             return 0
 
+        stats = self.graph.counters
         candidates = []
         def distance_recursion(seen_faces, current_face, distance):
+            if stats.enabled:
+                stats.count(("get_distance", "nodes visited"))
+                stats.maximum(("get_distance", "max depth"), len(seen_faces))
             if current_face == other:
                 candidates.append(distance)
             for neighbor_face, neighbor_distance in current_face.neighbors:
@@ -336,9 +1998,11 @@ class Face:
                         new_distance)
 
         distance_recursion(set([self]), self, 0)
+        if stats.enabled:
+            stats.count(("get_distance", "candidates"), len(candidates))
 
         if len(candidates) > 2:
-            pdb.set_trace()
+            import pdb; pdb.set_trace()
             raise NotImplementedError
         elif len(candidates) == 1:
             #if isinstance(candidates[0], DistanceConstraint):
@@ -359,7 +2023,7 @@ class Normal:
         self.is_positive = is_positive
 
     def copy(self):
-        return Normal(Face(self.dimension), self.is_positive)
+        return Normal(Face(self.dimension, self.face.system), self.is_positive)
 
     def offset_copy(self, offset):
         new_normal = self.copy()
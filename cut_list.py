@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Cut lists for the boards of a solved WoodSystem: which stock lengths to
+# buy and how to cut every board from them (1D cutting-stock). Every cut
+# eats kerf, so a piece takes length + kerf of a bar whose capacity is
+# stock length + kerf, the last piece of a bar needs no cut after it.
+
+import bisect
+import itertools
+import math
+
+from woods import woods
+
+class Bar:
+    def __init__(self, material, length):
+        self.material = material
+        self.length = length
+        # list of piece tuples: (length, block)
+        self.pieces = []
+
+    def get_used_length(self, kerf=0):
+        if not self.pieces:
+            return 0
+        return sum(length for length, block in self.pieces)\
+                + kerf*(len(self.pieces) - 1)
+
+    def get_waste(self, kerf=0):
+        return self.length - self.get_used_length(kerf)
+
+class CutList:
+    def __init__(self, kerf=0):
+        self.kerf = kerf
+        # material: [Bar]
+        self.bars = {}
+        # list of piece tuples that don't fit any stock length:
+        # (material, length, block)
+        self.oversized = []
+
+    def get_purchase_list(self):
+        return {material: len(bars) for material, bars in self.bars.items()}
+
+    def get_waste(self):
+        return sum(bar.get_waste(self.kerf)
+                for bars in self.bars.values() for bar in bars)
+
+    def format(self):
+        lines = []
+        for material, bars in sorted(self.bars.items()):
+            lines.append("{}: {} x {}".format(
+                material, len(bars), bars[0].length if bars else 0))
+            for i, bar in enumerate(bars):
+                lines.append("  {:4d}: {} (waste {:.1f})".format(
+                    i + 1,
+                    " + ".join("{:.1f}".format(length)
+                        for length, block in bar.pieces),
+                    bar.get_waste(self.kerf)))
+        for material, length, block in self.oversized:
+            lines.append("{}: {:.1f} is longer than the stock".format(
+                material, length))
+        return "\n".join(lines)
+
+def collect_pieces(system, include_hidden=True):
+    pieces = {}
+    for block in itertools.chain(system.blocks, system.placed_blocks()):
+        material = getattr(block, "material", None)
+        if material is None or not (include_hidden or block.visible):
+            continue
+        length = abs(block.get_computed_length(block.length_dimension))
+        pieces.setdefault(material, []).append((length, block))
+    return pieces
+
+def best_fit_decreasing(pieces, stock_length, kerf=0):
+    # Longest pieces first, each into the fullest bar it still fits.
+    # remaining is kept sorted so the bar is found by bisection.
+    capacity = stock_length + kerf
+    bars = []
+    remaining = []
+    for length, block in sorted(pieces, key=lambda piece: -piece[0]):
+        need = length + kerf
+        i = bisect.bisect_left(remaining, (need, -1))
+        if i == len(remaining):
+            bars.append([])
+            bar = len(bars) - 1
+            left = capacity - need
+        else:
+            left, bar = remaining.pop(i)
+            left -= need
+        bars[bar].append((length, block))
+        bisect.insort(remaining, (left, bar))
+    return bars
+
+def knapsack(values, sizes, counts, capacity):
+    # Bounded knapsack by dynamic programming over integer capacities,
+    # items split into powers of two. Returns the chosen count per item.
+    import numpy
+
+    items = []
+    for i, count in enumerate(counts):
+        k = 1
+        while count > 0:
+            take = min(k, count)
+            items.append((i, take))
+            count -= take
+            k *= 2
+
+    best = numpy.zeros(capacity + 1)
+    taken = []
+    for i, take in items:
+        size = sizes[i]*take
+        value = values[i]*take
+        row = numpy.zeros(capacity + 1, dtype=bool)
+        if value > 0 and size <= capacity:
+            candidate = best[:capacity + 1 - size] + value
+            row[size:] = candidate > best[size:]
+            best[size:] = numpy.where(row[size:], candidate, best[size:])
+        taken.append(row)
+
+    chosen = [0]*len(counts)
+    c = capacity
+    for (i, take), row in zip(reversed(items), reversed(taken)):
+        if row[c]:
+            chosen[i] += take
+            c -= sizes[i]*take
+    return chosen
+
+def column_generation(
+        pieces, stock_length, kerf=0, resolution=1, max_iterations=100):
+    # Gilmore-Gomory: the LP relaxation over cutting patterns is solved
+    # with new patterns priced in by knapsack on the duals. The rounded
+    # down LP solution is cut first and the rest is left to
+    # best_fit_decreasing. The heuristic solution seeds the patterns and is
+    # returned instead if it turns out to need fewer bars, or as soon as
+    # the LP bound shows that nothing needs fewer. Lengths are rounded up
+    # to resolution for the knapsack, so patterns never overfill a bar.
+    # With many distinct lengths, a coarser resolution or fewer iterations
+    # trade optimality for time.
+    if not pieces:
+        return []
+    from scipy.optimize import linprog
+
+    by_size = {}
+    for length, block in pieces:
+        size = math.ceil((length + kerf)/resolution)
+        by_size.setdefault(size, []).append((length, block))
+    sizes = sorted(by_size, reverse=True)
+    demand = [len(by_size[size]) for size in sizes]
+    capacity = math.floor((stock_length + kerf)/resolution)
+
+    heuristic_bars = best_fit_decreasing(pieces, stock_length, kerf)
+    size_index = {size: i for i, size in enumerate(sizes)}
+    patterns = []
+    for i, size in enumerate(sizes):
+        pattern = [0]*len(sizes)
+        pattern[i] = min(demand[i], capacity//size)
+        patterns.append(pattern)
+    for bar in heuristic_bars:
+        pattern = [0]*len(sizes)
+        for length, block in bar:
+            pattern[size_index[math.ceil((length + kerf)/resolution)]] += 1
+        if sum(n*size for n, size in zip(pattern, sizes)) <= capacity:
+            patterns.append(pattern)
+
+    solved = None
+    for iteration in range(max_iterations + 1):
+        result = linprog(
+                [1]*len(patterns),
+                A_ub=[[-pattern[i] for pattern in patterns]
+                    for i in range(len(sizes))],
+                b_ub=[-d for d in demand],
+                bounds=(0, None),
+                method="highs")
+        if result.status != 0:
+            # keep the patterns of the last LP that was solved
+            if solved is None:
+                return heuristic_bars
+            result = solved
+            break
+        solved = result
+        if math.ceil(result.fun - 1e-9) >= len(heuristic_bars):
+            return heuristic_bars
+        duals = [-marginal for marginal in result.ineqlin.marginals]
+        pattern = knapsack(duals, sizes, demand, capacity)
+        if (iteration == max_iterations
+                or sum(d*n for d, n in zip(duals, pattern)) <= 1 + 1e-9):
+            break
+        patterns.append(pattern)
+
+    bars = []
+    left = [by_size[size] for size in sizes]
+    for pattern, x in zip(patterns, result.x):
+        for copy in range(int(math.floor(x + 1e-9))):
+            if any(n > len(left[i]) for i, n in enumerate(pattern)):
+                break
+            bars.append([left[i].pop() for i, n in enumerate(pattern)
+                for k in range(n)])
+    rest = [piece for pieces_left in left for piece in pieces_left]
+    bars += best_fit_decreasing(rest, stock_length, kerf)
+    return bars if len(bars) < len(heuristic_bars) else heuristic_bars
+
+def create_cut_list(
+        system, kerf=0, exact=False, include_hidden=True, stock_lengths=None,
+        resolution=1, max_iterations=100):
+    # resolution and max_iterations: see column_generation
+    cut_list = CutList(kerf)
+    for material, pieces in collect_pieces(system, include_hidden).items():
+        if stock_lengths is not None and material in stock_lengths:
+            stock_length = stock_lengths[material]
+        else:
+            stock_length = woods[material]["max_length"]
+        cut_list.oversized.extend((material, length, block)
+                for length, block in pieces if length > stock_length)
+        pieces = [piece for piece in pieces if piece[0] <= stock_length]
+        if exact:
+            piece_bars = column_generation(
+                    pieces, stock_length, kerf, resolution, max_iterations)
+        else:
+            piece_bars = best_fit_decreasing(pieces, stock_length, kerf)
+
+        bars = cut_list.bars.setdefault(material, [])
+        for piece_bar in piece_bars:
+            bar = Bar(material, stock_length)
+            bar.pieces = piece_bar
+            bars.append(bar)
+    return cut_list
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Face positions as a linear function of the Parameters used as bind
+# offsets. Solving adds up offsets along a tree of exact binds from origo,
+# so every position is its solved value plus a sum of parameter changes
+# along the same tree: s = s0 + J (p - p0) with a sparse J. Variants that
+# only change parameter values are then evaluated all at once, without
+# building or solving anything. The map keeps everything else of the
+# compiled system: parameters that change what gets built (stud spacing
+# and the number of studs) can't be varied, and offsets that builders
+# work out from distances while building (centering) keep their values.
+
+import numpy
+import scipy.sparse
+
+from constraint_system import *
+
+class LinearMap:
+    def __init__(self, names, values, positions, matrices):
+        # parameter names and the values they were compiled with
+        self.names = names
+        self.values = numpy.array(values, dtype=numpy.float64)
+        # dimension: positions of the faces in the compiled system, NaN
+        # where not solved
+        self.positions = positions
+        # dimension: sparse matrix of faces x parameters
+        self.matrices = matrices
+
+    def get_parameter_matrix(self, values):
+        # values: name: number or array of variants, the rest of the
+        # parameters keep their compiled values
+        unknown = set(values) - set(self.names)
+        if unknown:
+            raise KeyError(
+                    "Unknown parameters: " + ", ".join(sorted(unknown)))
+        variants = max((numpy.size(value) for value in values.values()),
+                default=1)
+        parameters = numpy.repeat(self.values[:, None], variants, axis=1)
+        for i, name in enumerate(self.names):
+            if name in values:
+                parameters[i] = values[name]
+        return parameters
+
+    def evaluate(self, values):
+        # dimension: faces x variants array of positions
+        delta = self.get_parameter_matrix(values) - self.values[:, None]
+        return {dimension: self.positions[dimension][:, None]
+                    + self.matrices[dimension] @ delta
+                for dimension in Dimension}
+
+    def evaluate_blocks(self, blocks, values):
+        # (low corners, high corners) as variants x blocks x 3 arrays
+        positions = self.evaluate(values)
+        variants = next(iter(positions.values())).shape[1]
+        low = numpy.empty((variants, len(blocks), 3))
+        high = numpy.empty((variants, len(blocks), 3))
+        for axis, dimension in enumerate(Dimension):
+            ids = numpy.array([[face.id for face in block.faces[dimension]]
+                for block in blocks], dtype=numpy.int64).reshape(-1, 2)
+            face_0 = positions[dimension][ids[:, 0]]
+            face_1 = positions[dimension][ids[:, 1]]
+            low[:, :, axis] = numpy.minimum(face_0, face_1).T
+            high[:, :, axis] = numpy.maximum(face_0, face_1).T
+        return low, high
+
+def compile_system(system):
+    # The breadth-first search of solve_dimension, keeping the parameter
+    # terms of every position next to its value.
+    names = {}
+    rows = {}
+    positions = {}
+    for dimension, graph in system.graphs.items():
+        s = [None]*len(graph.faces)
+        # face: {name: coefficient}
+        terms = [None]*len(graph.faces)
+        leave_faces = [face.id for face in system.origo.faces[dimension]]
+        for face in leave_faces:
+            s[face] = graph.s[face]
+            terms[face] = {}
+        while leave_faces:
+            new_leave_faces = []
+            for old_face in leave_faces:
+                edge = graph.head[old_face]
+                while edge != -1:
+                    neighbor = graph.edge_face[edge]
+                    offset = graph.offsets[edge]
+                    if (graph.alive[edge] and s[neighbor] is None
+                            and not isinstance(offset, DistanceConstraint)):
+                        s[neighbor] = s[old_face] + offset
+                        terms[neighbor] = dict(terms[old_face])
+                        parameter = graph.parameters.get(edge & ~1)
+                        if parameter is not None:
+                            sign = -1 if edge & 1 else 1
+                            for name, coefficient in parameter.terms.items():
+                                terms[neighbor][name] = (
+                                        terms[neighbor].get(name, 0)
+                                        + sign*coefficient)
+                                value = parameter.values[name]
+                                if names.setdefault(name, value) != value:
+                                    raise ValueError("Parameter {} has "
+                                            "values {} and {}.".format(
+                                                name, names[name], value))
+                        new_leave_faces.append(neighbor)
+                    edge = graph.next_edge[edge]
+            leave_faces = new_leave_faces
+        positions[dimension] = numpy.array(
+                [numpy.nan if position is None else position
+                    for position in s], dtype=numpy.float64)
+        rows[dimension] = terms
+
+    names = dict(sorted(names.items()))
+    columns = {name: i for i, name in enumerate(names)}
+    matrices = {}
+    for dimension, terms in rows.items():
+        row, column, data = [], [], []
+        for face, face_terms in enumerate(terms):
+            for name, coefficient in (face_terms or {}).items():
+                if coefficient:
+                    row.append(face)
+                    column.append(columns[name])
+                    data.append(coefficient)
+        matrices[dimension] = scipy.sparse.csr_matrix(
+                (data, (row, column)), shape=(len(terms), len(names)))
+    return LinearMap(list(names), list(names.values()), positions, matrices)
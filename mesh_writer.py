@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Writes the boxes as meshes straight from the solved coordinates, so no
+# OpenSCAD (and no CGAL union) is needed for an STL. All vertices and
+# faces are made at once with NumPy from the (translation, size) boxes of
+# get_boxes(). The boxes aren't unioned: touching boards stay separate
+# closed shells, which slicers and viewers handle fine. Binary STL has
+# triangles only, OBJ groups and PLY faces keep the board they belong to.
+
+import numpy
+
+from scad_writer import open_output
+
+header = "Generated by Vaja"
+
+# corner k of a box is at (k & 1, k >> 1 & 1, k >> 2 & 1) times its size
+corners = numpy.array([[k & 1, k >> 1 & 1, k >> 2 & 1] for k in range(8)],
+        dtype=numpy.float64)
+
+# sides as corners counterclockwise seen from outside: -X, +X, -Y, +Y, -Z, +Z
+quads = numpy.array([
+    [0, 4, 6, 2], [1, 3, 7, 5],
+    [0, 1, 5, 4], [2, 6, 7, 3],
+    [0, 2, 3, 1], [4, 5, 7, 6]])
+
+normals = numpy.array([
+    [-1, 0, 0], [1, 0, 0],
+    [0, -1, 0], [0, 1, 0],
+    [0, 0, -1], [0, 0, 1]], dtype=numpy.float32)
+
+# two triangles per side
+triangles = quads[:, [0, 1, 2, 0, 2, 3]].reshape(-1, 3)
+triangle_normals = numpy.repeat(normals, 2, axis=0)
+
+stl_facet = numpy.dtype([
+    ("normal", "<f4", (3,)),
+    ("vertices", "<f4", (3, 3)),
+    ("attribute", "<u2")])
+
+ply_face = numpy.dtype([
+    ("count", "u1"),
+    ("indices", "<i4", (4,)),
+    ("board", "<i4")])
+
+def box_arrays(boxes):
+    # translations and sizes as boxes x 3 arrays, a negative size starts
+    # the box from the other end like it would in OpenSCAD
+    arrays = numpy.array(list(boxes), dtype=numpy.float64).reshape(-1, 2, 3)
+    translations, sizes = arrays[:, 0], arrays[:, 1]
+    return translations + numpy.minimum(sizes, 0), numpy.abs(sizes)
+
+def box_vertices(boxes):
+    # boxes x 8 x 3
+    translations, sizes = box_arrays(boxes)
+    return translations[:, None, :] + corners[None]*sizes[:, None, :]
+
+def write_stl(boxes, output):
+    vertices = box_vertices(boxes)
+    facets = numpy.zeros(len(vertices)*len(triangles), dtype=stl_facet)
+    facets["normal"] = numpy.tile(triangle_normals, (len(vertices), 1))
+    facets["vertices"] = vertices[:, triangles].reshape(-1, 3, 3)
+    with open_output(output, "wb") as output_file:
+        # a header starting with "solid" would look like ASCII STL
+        output_file.write(header.encode().ljust(80, b"\0"))
+        output_file.write(numpy.array(len(facets), dtype="<u4").tobytes())
+        output_file.write(facets.tobytes())
+
+def write_obj(boxes, names, output):
+    # names: a group name without whitespace for every box
+    vertices = box_vertices(boxes)
+    vertex_lines = "v {:.10g} {:.10g} {:.10g}\n"*len(corners)
+    face_lines = "f {} {} {} {}\n"*len(quads)
+    with open_output(output) as output_file:
+        output_file.write("# {}\n".format(header))
+        for i, (name, box) in enumerate(zip(names, vertices.tolist())):
+            output_file.write("g {}\n".format(name))
+            output_file.write(vertex_lines.format(
+                *(coordinate for corner in box for coordinate in corner)))
+            # OBJ counts vertices from 1
+            output_file.write(face_lines.format(
+                *(quads.ravel() + len(corners)*i + 1).tolist()))
+
+def write_ply(boxes, names, output):
+    # Binary PLY with quads, the board property of a face is the index of
+    # its box and the names of the boards are in the comments.
+    vertices = box_vertices(boxes)
+    boards = len(vertices)
+    faces = numpy.zeros(boards*len(quads), dtype=ply_face)
+    faces["count"] = 4
+    faces["indices"] = (quads[None]
+            + len(corners)*numpy.arange(boards)[:, None, None]).reshape(-1, 4)
+    faces["board"] = numpy.repeat(numpy.arange(boards), len(quads))
+    lines = ["ply", "format binary_little_endian 1.0",
+            "comment " + header]
+    lines.extend("comment board {} {}".format(i, name)
+            for i, name in enumerate(names))
+    lines.extend([
+        "element vertex {}".format(boards*len(corners)),
+        "property float x", "property float y", "property float z",
+        "element face {}".format(len(faces)),
+        "property list uchar int vertex_indices",
+        "property int board",
+        "end_header"])
+    with open_output(output, "wb") as output_file:
+        output_file.write(("\n".join(lines) + "\n").encode())
+        output_file.write(vertices.astype("<f4").tobytes())
+        output_file.write(faces.tobytes())
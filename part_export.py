@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Writes a file per exported board and per assembly (see
+# ConstraintSystem.assembly()) into a directory, with a manifest.json
+# listing them. The solved geometry is first taken into Part tuples of
+# plain numbers, which are cheap to pickle, and the files are written
+# from those in a process pool. The parts and the manifest are in the
+# export order of the boards, so the output doesn't depend on the pool.
+
+import os
+import io
+import json
+import hashlib
+import collections
+
+import scad_writer
+
+Part = collections.namedtuple("Part", "file kind name boards boxes")
+
+formats = ("scad", "stl", "obj", "ply")
+
+def safe_name(name):
+    return "_".join(str(name).split()).replace(os.sep, "_")
+
+def unique_file(name, format, files):
+    # safe_name can map different names to the same file, later ones get
+    # a number
+    file_name = "{}.{}".format(name, format)
+    number = 1
+    while file_name in files:
+        number += 1
+        file_name = "{}_{}.{}".format(name, number, format)
+    files.add(file_name)
+    return file_name
+
+def board_length(block):
+    length_dimension = getattr(block, "length_dimension", None)
+    if length_dimension is None:
+        return None
+    return abs(block.get_computed_length(length_dimension))
+
+def collect_parts(blocks, names, format):
+    # blocks: the exported blocks, names: a board name for each one
+    parts = []
+    files = set()
+    boards = {}
+    assemblies = {}
+    for block, name in zip(blocks, names):
+        box = block.get_box()
+        boards[name] = {
+            "material": getattr(block, "material", None),
+            "length": board_length(block),
+        }
+        parts.append(Part(unique_file(safe_name(name), format, files),
+                "board", name, (name,), (box,)))
+        path = getattr(block, "assembly", ())
+        # a board is in its assembly and in all the enclosing ones
+        for end in range(1, len(path) + 1):
+            assembly = assemblies.setdefault(path[:end], ([], []))
+            assembly[0].append(name)
+            assembly[1].append(box)
+    for path, (assembly_boards, boxes) in assemblies.items():
+        name = "/".join(path)
+        file_name = unique_file("assembly_" + "-".join(
+                safe_name(part) for part in path), format, files)
+        parts.append(Part(file_name, "assembly", name,
+                tuple(assembly_boards), tuple(boxes)))
+    return parts, boards
+
+def render_part(part, format):
+    if format == "scad":
+        output = io.StringIO()
+        scad_writer.write_boxes(part.boxes, output)
+        return output.getvalue().encode()
+    import mesh_writer
+    if format == "obj":
+        output = io.StringIO()
+        mesh_writer.write_obj(part.boxes, part.boards, output)
+        return output.getvalue().encode()
+    output = io.BytesIO()
+    if format == "stl":
+        mesh_writer.write_stl(part.boxes, output)
+    else:
+        mesh_writer.write_ply(part.boxes, part.boards, output)
+    return output.getvalue()
+
+def write_part(directory, format, part):
+    # Runs in the pool, returns the manifest entry of the part.
+    data = render_part(part, format)
+    with open(os.path.join(directory, part.file), "wb") as output_file:
+        output_file.write(data)
+    return {
+        "file": part.file,
+        "kind": part.kind,
+        "name": part.name,
+        "boards": list(part.boards),
+        "bytes": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+def write_parts(blocks, names, directory, format="scad", processes=None):
+    if format not in formats:
+        raise ValueError("Unknown part format: " + format)
+    parts, boards = collect_parts(blocks, names, format)
+    os.makedirs(directory, exist_ok=True)
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes == 1 or len(parts) < 2:
+        entries = [write_part(directory, format, part) for part in parts]
+    else:
+        import itertools
+        import concurrent.futures
+        # a few chunks per process, one part per task would spend more
+        # time in pickling than in writing
+        chunksize = max(1, len(parts)//(processes*4))
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            entries = list(pool.map(write_part, itertools.repeat(directory),
+                    itertools.repeat(format), parts, chunksize=chunksize))
+
+    for entry in entries:
+        if entry["kind"] == "board":
+            entry.update(boards[entry["name"]])
+    manifest = {"format": format, "parts": entries}
+    with open(os.path.join(directory, "manifest.json"), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+        manifest_file.write("\n")
+    return manifest
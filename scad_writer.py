@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Writes OpenSCAD files line by line without building a SolidPython tree.
+# Numbers are formatted the same way SolidPython does, so the geometry is
+# byte for byte the same as in scad_render_to_file output.
+
+import os
+import contextlib
+
+header = "// Generated by Vaja\n\n\n"
+
+def scad_value(value):
+    if type(value) == bool:
+        return str(value).lower()
+    if type(value) == float:
+        return f"{value:.10f}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(scad_value(v) for v in value) + "]"
+    return str(value)
+
+@contextlib.contextmanager
+def open_output(output, mode="w"):
+    if isinstance(output, (str, os.PathLike)):
+        with open(output, mode) as output_file:
+            yield output_file
+    else:
+        yield output
+
+def write_boxes(boxes, output):
+    # boxes: iterable of (translation, size) pairs
+    with open_output(output) as output_file:
+        output_file.write(header)
+        output_file.write("union() {\n")
+        for translation, size in boxes:
+            output_file.write(
+                    "\ttranslate(v = {}) {{\n\t\tcube(size = {});\n\t}}\n"
+                    .format(scad_value(translation), scad_value(size)))
+        output_file.write("}\n")
+
+def write_instanced_boxes(boxes, output, module_prefix="board"):
+    # Every distinct size becomes one module and every box a call of it.
+    # OpenSCAD doesn't care where modules are defined, so they are written
+    # after the placements and only the distinct sizes are kept in memory.
+    modules = {}
+    with open_output(output) as output_file:
+        output_file.write(header)
+        output_file.write("union() {\n")
+        for translation, size in boxes:
+            key = tuple(size)
+            if key not in modules:
+                modules[key] = ("{}_{}".format(module_prefix, len(modules)),
+                        size)
+            output_file.write("\ttranslate(v = {}) {}();\n".format(
+                scad_value(translation), modules[key][0]))
+        output_file.write("}\n")
+        for name, size in modules.values():
+            output_file.write("\nmodule {}() {{\n\tcube(size = {});\n}}\n"
+                    .format(name, scad_value(size)))
+
+def write_comments(comments, output):
+    # Appends the comments to an already written output, line by line.
+    with open_output(output, "a") as output_file:
+        for comment in comments:
+            for line in comment.splitlines():
+                output_file.write("// {}\n".format(line))
@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Saves a built (and possibly solved) ConstraintSystem into a NumPy .npz
+# file and restores it without running any of the building code. Faces
+# and binds are stored as the arrays of the face graphs, blocks as the ids
+# of their faces. Offsets and positions are stored as the float64 values
+# and kinds of their Numbers, with DistanceConstraints as kinds of their
+# own instead of objects, so the restored ones are ints where they were
+# integers and floats otherwise. Parameters of binds are
+# stored as JSON, so compile() works on a loaded system, and so are the
+# assemblies of the blocks. Deferred binds
+# are closures and can't be saved, neither can provenance. Systems with
+# placed templates (template.py) can't be saved at all.
+
+import os
+import json
+import hashlib
+import array
+from numbers import Integral, Real
+
+import numpy
+
+from constraint_system import *
+
+format_version = 3
+
+# kinds of stored numbers, the ones of Numbers except for the objects
+INT = Numbers.INT
+FLOAT = Numbers.FLOAT
+NONE = Numbers.NONE
+# DistanceConstraints by equality
+CONSTRAINT = {Equality.GT: 3, Equality.LT: 4, Equality.EQ: 5}
+EQUALITY = {kind: equality for equality, kind in CONSTRAINT.items()}
+
+def encode_numbers(numbers):
+    # kinds and values arrays of a Numbers
+    kinds = numpy.frombuffer(numbers.kinds, dtype=numpy.uint8).astype(
+            numpy.int8)
+    values = numpy.frombuffer(numbers.values, dtype=numpy.float64).copy()
+    for i, number in numbers.objects.items():
+        if isinstance(number, DistanceConstraint):
+            kinds[i] = CONSTRAINT[number.equality]
+            number = number.value
+        elif isinstance(number, Integral):
+            kinds[i] = INT
+        elif isinstance(number, Real):
+            kinds[i] = FLOAT
+        else:
+            raise TypeError("Can't store {!r}.".format(number))
+        values[i] = number
+        if kinds[i] == INT and values[i] != number:
+            raise ValueError("Integer {} can't be stored exactly.".format(
+                number))
+    return kinds, values
+
+def decode_numbers(kinds, values):
+    # the Numbers of stored kinds and values, DistanceConstraints become
+    # its objects
+    numbers = Numbers()
+    numbers.values = array.array('d', values.astype(numpy.float64).tobytes())
+    numbers.kinds = bytearray(numpy.minimum(kinds, Numbers.OBJECT).astype(
+            numpy.uint8).tobytes())
+    for i in numpy.flatnonzero(kinds > NONE).tolist():
+        numbers.objects[i] = DistanceConstraint(
+                EQUALITY[int(kinds[i])], float(values[i]))
+    return numbers
+
+def block_classes():
+    classes = {}
+    pending = [ConstrainedBlock]
+    while pending:
+        block_class = pending.pop()
+        classes[block_class.__name__] = block_class
+        pending.extend(block_class.__subclasses__())
+    return classes
+
+def save(system, path):
+    if system.instances:
+        raise ValueError("Systems with placed templates can't be saved.")
+    arrays = {"format_version": numpy.array(format_version)}
+    for dimension, graph in system.graphs.items():
+        prefix = dimension.name + "_"
+        edges = [edge for edge in range(0, len(graph.alive), 2)
+                if graph.alive[edge]]
+        arrays[prefix + "edges"] = numpy.array(
+                [(graph.edge_face[edge + 1], graph.edge_face[edge])
+                    for edge in edges], dtype=numpy.int64).reshape(-1, 2)
+        kinds, values = encode_numbers(graph.offsets)
+        arrays[prefix + "offset_kinds"] = kinds[edges]
+        arrays[prefix + "offsets"] = values[edges]
+        # [bind, value, terms, values] of the binds made with Parameters
+        arrays[prefix + "parameters"] = numpy.array(json.dumps(
+                [[k, parameter.value, parameter.terms, parameter.values]
+                    for k, parameter in ((k, graph.parameters.get(edge))
+                        for k, edge in enumerate(edges))
+                    if parameter is not None], default=float))
+        arrays[prefix + "parent"] = numpy.array(
+                graph.parent, dtype=numpy.int64)
+        (arrays[prefix + "parent_offset_kinds"],
+                arrays[prefix + "parent_offsets"]) = encode_numbers(
+                        graph.parent_offset)
+        arrays[prefix + "rank"] = numpy.array(graph.rank, dtype=numpy.int8)
+        arrays[prefix + "s_kinds"], arrays[prefix + "s"] =\
+                encode_numbers(graph.s)
+        arrays[prefix + "origo"] = numpy.array(
+                [face.id for face in system.origo.faces[dimension]],
+                dtype=numpy.int64)
+
+    # (block, dimension, low/high) face ids
+    arrays["block_faces"] = numpy.array(
+            [[[face.id for face in block.faces[dimension]]
+                for dimension in Dimension] for block in system.blocks],
+            dtype=numpy.int64).reshape(-1, len(Dimension), 2)
+    arrays["block_classes"] = numpy.array(
+            [type(block).__name__ for block in system.blocks], dtype=str)
+    arrays["block_names"] = numpy.array(
+            [getattr(block, "name", "") for block in system.blocks], dtype=str)
+    arrays["block_materials"] = numpy.array(
+            [getattr(block, "material", "") for block in system.blocks],
+            dtype=str)
+    # assembly path of every block, see ConstraintSystem.assembly()
+    arrays["block_assemblies"] = numpy.array(json.dumps(
+            [list(getattr(block, "assembly", ())) for block in system.blocks]))
+    # -1 for blocks without visibility
+    arrays["block_visible"] = numpy.array(
+            [int(block.visible) if hasattr(block, "visible") else -1
+                for block in system.blocks], dtype=numpy.int8)
+    arrays["block_length_dimensions"] = numpy.array(
+            [getattr(block, "length_dimension", None).value
+                if getattr(block, "length_dimension", None) is not None
+                else -1 for block in system.blocks], dtype=numpy.int8)
+    arrays["solved"] = numpy.array(system.solved)
+    numpy.savez_compressed(path, **arrays)
+
+def restore_graph(graph, arrays, prefix):
+    parent = arrays[prefix + "parent"]
+    faces = len(parent)
+    graph.faces = []
+    for face_id in range(faces):
+        face = Face.__new__(Face)
+        face.graph = graph
+        face.id = face_id
+        graph.faces.append(face)
+    graph.parent = array.array('l', parent.tolist())
+    graph.parent_offset = decode_numbers(
+            arrays[prefix + "parent_offset_kinds"],
+            arrays[prefix + "parent_offsets"])
+    graph.rank = array.array('b', arrays[prefix + "rank"].tolist())
+    graph.generations = array.array('l', [0])*faces
+    graph.s = decode_numbers(arrays[prefix + "s_kinds"], arrays[prefix + "s"])
+    kinds = arrays[prefix + "offset_kinds"]
+    values = arrays[prefix + "offsets"]
+    edges = arrays[prefix + "edges"]
+
+    # The same half-edge lists add_edge would make: half-edge 2k goes
+    # from edges[k][0] to edges[k][1] and 2k + 1 back, and the list of a
+    # face is in the order of its half-edges.
+    sources = edges.reshape(-1)
+    targets = edges[:, ::-1].reshape(-1)
+    order = numpy.argsort(sources, kind="stable")
+    next_edge = numpy.full(len(sources), -1, dtype=numpy.int64)
+    same = sources[order[:-1]] == sources[order[1:]]
+    next_edge[order[:-1][same]] = order[1:][same]
+    first = numpy.ones(len(order), dtype=bool)
+    first[1:] = ~same
+    last = numpy.ones(len(order), dtype=bool)
+    last[:-1] = ~same
+    head = numpy.full(faces, -1, dtype=numpy.int64)
+    tail = numpy.full(faces, -1, dtype=numpy.int64)
+    head[sources[order[first]]] = order[first]
+    tail[sources[order[last]]] = order[last]
+    graph.head = array.array('l', head.tolist())
+    graph.tail = array.array('l', tail.tolist())
+    graph.edge_face = array.array('l', targets.tolist())
+    graph.next_edge = array.array('l', next_edge.tolist())
+    graph.alive = bytearray(b"\x01")*len(sources)
+    # half-edge 2k + 1 has the negated offset of 2k
+    half_values = numpy.repeat(values, 2)
+    half_values[1::2] *= -1
+    graph.offsets = decode_numbers(numpy.repeat(kinds, 2), half_values)
+    for edge in [edge for edge in graph.offsets.objects if edge % 2 == 0]:
+        graph.offsets.objects[edge + 1] = -graph.offsets.objects[edge]
+    graph.dead_edges = 0
+    graph.parameters = {2*k: Parameter(value, terms=terms, values=values)
+            for k, value, terms, values
+            in json.loads(str(arrays[prefix + "parameters"]))}
+    graph.version += 1
+    for edge, offset in graph.offsets.objects.items():
+        if edge % 2 == 0:
+            face_0, face_1 = edges[edge//2].tolist()
+            graph.bounds.add(graph.faces[face_0], graph.faces[face_1], offset)
+
+def load(path, system_class=ConstraintSystem):
+    with numpy.load(path) as arrays:
+        if int(arrays["format_version"]) != format_version:
+            raise ValueError("Unsupported snapshot format version {}.".format(
+                int(arrays["format_version"])))
+        system = system_class()
+        for dimension, graph in system.graphs.items():
+            restore_graph(graph, arrays, dimension.name + "_")
+        system.origo.faces = {dimension: tuple(
+                system.graphs[dimension].faces[face_id]
+                for face_id in arrays[dimension.name + "_origo"].tolist())
+                for dimension in Dimension}
+
+        classes = block_classes()
+        graph_faces = [(dimension, system.graphs[dimension].faces)
+                for dimension in Dimension]
+        system.blocks = []
+        for block_faces, class_name, name, material, assembly, visible,\
+                length_dimension in zip(arrays["block_faces"].tolist(),
+                    arrays["block_classes"].tolist(),
+                    arrays["block_names"].tolist(),
+                    arrays["block_materials"].tolist(),
+                    json.loads(str(arrays["block_assemblies"])),
+                    arrays["block_visible"].tolist(),
+                    arrays["block_length_dimensions"].tolist()):
+            block = classes[class_name].__new__(classes[class_name])
+            block.system = system
+            block.origin = None
+            block.faces = {dimension: (faces[low], faces[high])
+                    for (dimension, faces), (low, high)
+                    in zip(graph_faces, block_faces)}
+            if visible != -1:
+                block.visible = bool(visible)
+            if name:
+                block.name = name
+            if material:
+                block.material = material
+            if assembly:
+                block.assembly = tuple(assembly)
+            if length_dimension != -1:
+                block.length_dimension = Dimension(length_dimension)
+            system.blocks.append(block)
+        system.solved = bool(arrays["solved"])
+        if system.solved:
+            for graph in system.graphs.values():
+                graph.touched = array.array('l')
+            system.solved_versions = tuple(
+                    graph.version for graph in system.graphs.values())
+    return system
+
+def cache_path(cache_directory, parameters):
+    key = hashlib.sha256(json.dumps(
+        [format_version, parameters], sort_keys=True).encode()).hexdigest()
+    return os.path.join(cache_directory, key[:32] + ".npz")
+
+def cached(build, parameters, cache_directory,
+        system_class=ConstraintSystem):
+    # Loads the system built with the same parameters before, or calls
+    # build() and saves what it returns. parameters must be JSON
+    # serializable and cover everything the model depends on, including
+    # a version of the building code if it changes.
+    path = cache_path(cache_directory, parameters)
+    if os.path.exists(path):
+        return load(path, system_class)
+    system = build()
+    os.makedirs(cache_directory, exist_ok=True)
+    save(system, path)
+    return system
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+class SpatialIndex:
+    # Bounding volume hierarchy over axis-aligned boxes. It is bulk loaded
+    # by splitting the items at the median of the longest axis and stored
+    # in flat lists: node i covers node_low[i]..node_high[i] and either has
+    # children (node_left[i], node_right[i]) or, when node_left[i] == -1,
+    # holds the items order[node_start[i]:node_end[i]].
+    leaf_size = 8
+
+    def __init__(self, boxes, items=None):
+        # boxes: ((x0, y0, z0), (x1, y1, z1)) with x0 <= x1 and so on
+        self.boxes = list(boxes)
+        self.items = list(items) if items is not None else self.boxes
+        self.order = list(range(len(self.boxes)))
+        self.lows = [[box[0][axis] for box in self.boxes] for axis in range(3)]
+        self.highs = [[box[1][axis] for box in self.boxes] for axis in range(3)]
+        self.centers = [[low + high for low, high in zip(lows, highs)]
+                for lows, highs in zip(self.lows, self.highs)]
+        self.node_low = []
+        self.node_high = []
+        self.node_left = []
+        self.node_right = []
+        self.node_start = []
+        self.node_end = []
+        if self.boxes:
+            self.build()
+
+    def add_node(self, start, end):
+        order = self.order[start:end]
+        self.node_low.append(tuple(min(map(lows.__getitem__, order))
+            for lows in self.lows))
+        self.node_high.append(tuple(max(map(highs.__getitem__, order))
+            for highs in self.highs))
+        self.node_left.append(-1)
+        self.node_right.append(-1)
+        self.node_start.append(start)
+        self.node_end.append(end)
+        return len(self.node_low) - 1
+
+    def build(self):
+        stack = [self.add_node(0, len(self.order))]
+        while stack:
+            node = stack.pop()
+            start = self.node_start[node]
+            end = self.node_end[node]
+            if end - start <= self.leaf_size:
+                continue
+            low = self.node_low[node]
+            high = self.node_high[node]
+            axis = max(range(3), key=lambda a: high[a] - low[a])
+            self.order[start:end] = sorted(self.order[start:end],
+                    key=self.centers[axis].__getitem__)
+            middle = (start + end)//2
+            self.node_left[node] = self.add_node(start, middle)
+            self.node_right[node] = self.add_node(middle, end)
+            stack.append(self.node_left[node])
+            stack.append(self.node_right[node])
+
+    def query(self, low, high):
+        # Items whose boxes overlap or touch the box low..high.
+        found = []
+        if not self.boxes:
+            return found
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if not overlaps(
+                    self.node_low[node], self.node_high[node], low, high):
+                continue
+            if self.node_left[node] == -1:
+                for i in self.order[self.node_start[node]:self.node_end[node]]:
+                    if overlaps(self.boxes[i][0], self.boxes[i][1], low, high):
+                        found.append(i)
+            else:
+                stack.append(self.node_right[node])
+                stack.append(self.node_left[node])
+        return [self.items[i] for i in sorted(found)]
+
+    def __len__(self):
+        return len(self.boxes)
+
+def overlaps(low_0, high_0, low_1, high_1):
+    return all(low_0[axis] <= high_1[axis] and low_1[axis] <= high_0[axis]
+            for axis in range(3))
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Assemblies built and solved once in a ConstraintSystem of their own and
+# placed into other systems as instances. An instance is a single block
+# in the parent system, bound like the block the builder returns would be,
+# so the boards of the assembly add no faces or binds to the parent. The
+# boards are only placed when exporting, by translating their positions in
+# the local system. Instances can't be rotated or mirrored: builders that
+# take dimensions need a template per orientation.
+
+import types
+
+from constraint_system import *
+
+class Template:
+    def __init__(self, build, *args):
+        # build(system, *args) returns the block enclosing the assembly
+        self.build = build
+        self.args = args
+        self.system = None
+        # lengths of the enclosing block per dimension
+        self.lengths = None
+
+    def get_system(self, system_class):
+        # The local system, built on first use. The enclosing block starts
+        # from the local origo, so local positions are offsets from the low
+        # faces of an instance.
+        if self.system is not None:
+            return self.system
+        system = system_class()
+        outer = self.build(system, *self.args)
+        for dimension in Dimension:
+            system.origo.bind(outer, dimension)
+        for deferred in system.unsatisfied_binds():
+            raise RuntimeError("Template has unsatisfied binds: {!r}".format(
+                deferred))
+        report = system.find_underconstrained()
+        if report:
+            raise UnderconstrainedException(report.format())
+        system.solve()
+        self.lengths = {dimension: outer.get_computed_length(dimension)
+                for dimension in Dimension}
+        self.system = system
+        return system
+
+    def place(self, system):
+        return TemplateInstance(system, self)
+
+class TemplateInstance(ConstrainedBlock):
+    def __init__(self, system, template):
+        super().__init__(system)
+        self.template = template
+        template.get_system(type(system))
+        if system.assemblies:
+            self.assembly = tuple(system.assemblies)
+        for dimension, length in template.lengths.items():
+            self.bind_internally(dimension, length)
+        system.instances.append(self)
+
+    def get_placed_blocks(self):
+        for block in self.template.system.blocks:
+            yield PlacedBlock(block, self)
+
+class PlacedBlock:
+    # A block of a template system at the position of an instance. Other
+    # attributes come from the block, and methods of the block's class are
+    # bound to the placed block, so get_box() and the like use the placed
+    # positions.
+    def __init__(self, block, instance):
+        self.block = block
+        self.instance = instance
+
+    def __getattr__(self, name):
+        attribute = getattr(type(self.block), name, None)
+        if isinstance(attribute, types.FunctionType):
+            return types.MethodType(attribute, self)
+        return getattr(self.block, name)
+
+    @property
+    def assembly(self):
+        return (getattr(self.instance, "assembly", ())
+                + getattr(self.block, "assembly", ()))
+
+    def get_computed_length(self, dimension: Dimension):
+        return self.block.get_computed_length(dimension)
+
+    def get_position(self, dimension: Dimension):
+        return (self.instance.get_position(dimension)
+                + self.block.get_position(dimension))
+
+    def get_extent(self):
+        extent = self.block.get_extent()
+        instance_extent = self.instance.get_extent()
+        if extent is None or instance_extent is None:
+            return None
+        return tuple(tuple(instance_low + position
+                    for instance_low, position
+                    in zip(instance_extent[0], corner))
+                for corner in extent)
@@ -1,13 +1,14 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import os
+import sys
 import math
+import time
 
 from constraint_system import *
 from woods import *
 
-lazys = []
-
 def repeating(
         system, start_normal, stop_normal, end_normal_0, end_normal_1,
         surface_normal, material_name, difference, laid_flat,
@@ -28,9 +29,29 @@ def repeating(
             distance = abs(signed_distance)
         sign = 1 if start_normal.is_positive else -1
 
-        offset = start_offset
-        top_offset = 0
-        while offset + material_width <= distance:
+        with system.batch():
+            offset = start_offset
+            top_offset = 0
+            while offset + material_width <= distance:
+                if laid_flat:
+                    new_block = system.get_wood(
+                            material_name,
+                            end_normal_0.dimension,
+                            start_normal.dimension,
+                            visible)
+                else:
+                    new_block = system.get_wood(
+                            material_name,
+                            end_normal_0.dimension,
+                            surface_normal.dimension,
+                            visible)
+                start_normal.bind(new_block, sign*offset)
+                surface_normal.bind(new_block)
+                end_normal_0.bind(new_block)
+                end_normal_1.bind(new_block)
+                top_offset = offset + material_width
+                offset += difference
+
             if laid_flat:
                 new_block = system.get_wood(
                         material_name,
@@ -43,39 +64,17 @@ def repeating(
                         end_normal_0.dimension,
                         surface_normal.dimension,
                         visible)
-            start_normal.bind(new_block, sign*offset)
             surface_normal.bind(new_block)
             end_normal_0.bind(new_block)
             end_normal_1.bind(new_block)
-            top_offset = offset + material_width
-            offset += difference
-
-        if laid_flat:
-            new_block = system.get_wood(
-                    material_name,
-                    end_normal_0.dimension,
-                    start_normal.dimension,
-                    visible)
-        else:
-            new_block = system.get_wood(
-                    material_name,
-                    end_normal_0.dimension,
-                    surface_normal.dimension,
-                    visible)
-        surface_normal.bind(new_block)
-        end_normal_0.bind(new_block)
-        end_normal_1.bind(new_block)
-        if distance - top_offset < material_width:
-            new_block.unbind_internally(start_normal.dimension)
-            start_normal.bind(new_block, sign*top_offset)
-            stop_normal.bind(new_block)
-        else:
-            stop_normal.bind(new_block)
+            if distance - top_offset < material_width:
+                new_block.unbind_internally(start_normal.dimension)
+                start_normal.bind(new_block, sign*top_offset)
+                stop_normal.bind(new_block)
+            else:
+                stop_normal.bind(new_block)
 
-    try:
-        repeating_closure()
-    except DistanceNotConstrainedException:
-        lazys.append(repeating_closure)
+    system.defer(repeating_closure, (start_normal.face, stop_normal.face))
 
     outer_surface_normal = surface_normal.offset_copy(material_thickness)
     the_union = ConstrainedBlock.from_normals(
@@ -129,14 +128,12 @@ def bottom_beams(system, x_width, y_width):
 
     the_union = beams[0] + beams[2]
 
-    lazy_closure = beams[1].lazy_bind_centered(the_union, Dimension.Y)
-    if not lazy_closure is None:
-        lazys.append(lazy_closure)
+    beams[1].lazy_bind_centered(the_union, Dimension.Y)
 
     return the_union, beams
 
-def floor_support(system, bottom, x0, x1, y0, y1):
-    return repeating(system, x0, x1, y0, y1, bottom, "100x50", 600, False)
+def floor_support(system, bottom, x0, x1, y0, y1, spacing=600):
+    return repeating(system, x0, x1, y0, y1, bottom, "100x50", spacing, False)
 
 def california_corner(
         system, bottom_normal, top_normal, connecting_normal, outside_normal):
@@ -164,7 +161,7 @@ def california_corner(
 
 def wall_frame_w_corners(
         system, height, bottom_normal, floor_normal,
-        outside_normal, neg_end, pos_end):
+        outside_normal, neg_end, pos_end, spacing=600):
     bottom = system.get_wood(
             "100x50", neg_end.dimension, outside_normal.dimension)
     top = system.get_wood(
@@ -197,14 +194,14 @@ def wall_frame_w_corners(
         top.get_low_normal(Dimension.Z),
         outside_normal,
         "100x50",
-        600,
+        spacing,
         False)
 
     return bottom + top
 
 def wall_frame(
         system, height, bottom_normal, floor_normal,
-        outside_normal, neg_end, pos_end):
+        outside_normal, neg_end, pos_end, spacing=600):
     top = system.get_wood(
             "100x50", neg_end.dimension, outside_normal.dimension)
     floor_normal.bind(top, offset=height)
@@ -220,7 +217,7 @@ def wall_frame(
         top.get_low_normal(Dimension.Z),
         outside_normal,
         "100x50",
-        600,
+        spacing,
         False)
     return ribs + top
 
@@ -298,15 +295,11 @@ def pillars(system, beam):
         pillar.bind_internally(Dimension.Y, 240)
         pillar.bind_internally(Dimension.Z, 190)
 
-        lazy_closure = beam.lazy_bind_centered(pillar, Dimension.Y)
-        if not lazy_closure is None:
-            lazys.append(lazy_closure)
+        beam.lazy_bind_centered(pillar, Dimension.Y)
         beam.get_low_normal(Dimension.Z).bind(
                 pillar.get_high_normal(Dimension.Z))
 
-    lazy_closure = beam.lazy_bind_centered(pillars[1], Dimension.X)
-    if not lazy_closure is None:
-        lazys.append(lazy_closure)
+    beam.lazy_bind_centered(pillars[1], Dimension.X)
 
     pillars[0].get_low_face(Dimension.X).bind(
             beam.get_low_face(Dimension.X))
@@ -317,7 +310,7 @@ def pillars(system, beam):
 
 def wall_frame_w_door(
         system, height, bottom_normal, floor_normal,
-        outside_normal, neg_end, pos_end):
+        outside_normal, neg_end, pos_end, spacing=600, door_template=None):
     top = system.get_wood(
             "100x50", neg_end.dimension, outside_normal.dimension)
     floor_normal.bind(top, offset=height)
@@ -340,7 +333,10 @@ def wall_frame_w_door(
     outside_normal.bind(second)
     top.get_low_normal(Dimension.Z).bind(second)
 
-    the_door = door(system, neg_end.dimension)
+    if door_template is None:
+        the_door = door(system, neg_end.dimension)
+    else:
+        the_door = door_template.place(system)
     second.get_low_normal(pos_end.dimension).bind(the_door)
     floor_normal.bind(the_door)
     outside_normal.bind(the_door)
@@ -353,129 +349,274 @@ def wall_frame_w_door(
         top.get_low_normal(Dimension.Z),
         outside_normal,
         "100x50",
-        600,
+        spacing,
         False)
     return top + ribs
 
-def main():
-    verstas = WoodSystem()
-
-    beams, beam_blocks = bottom_beams(verstas, 3000, 3000)
+def shed(
+        verstas, x_offset=0, wall_width=3000,
+        cladding_width=math.sqrt(10000000), cladding_depth=math.sqrt(10000000),
+        wall_height=2700, stud_spacing=600, door_template=None):
+    # door_template: Template(door, Dimension.X) to place the door from
+    with verstas.assembly("bottom beams"):
+        beams, beam_blocks = bottom_beams(verstas, 3000, 3000)
 
     origo = verstas.origo
-    origo.bind(beams, Dimension.X)
+    origo.bind(beams, Dimension.X, offset=x_offset)
     origo.bind(beams, Dimension.Y)
     origo.bind(beams, Dimension.Z)
 
     floor_normal = Normal(Face(Dimension.Z), True)
 
-    wall_height = 2700
-
-    wall_frame_left = wall_frame_w_corners(
-            verstas,
-            wall_height,
-            beams.get_high_normal(Dimension.Z),
-            floor_normal,
-            beams.get_low_normal(Dimension.X).flipped(),
-            beams.get_low_normal(Dimension.Y).flipped(),
-            beams.get_high_normal(Dimension.Y).flipped())
-
-    wall_frame_right = wall_frame_w_corners(
-            verstas,
-            wall_height,
-            beams.get_high_normal(Dimension.Z),
-            floor_normal,
-            beams.get_high_normal(Dimension.X).flipped(),
-            beams.get_low_normal(Dimension.Y).flipped(),
-            beams.get_high_normal(Dimension.Y).flipped())
-
-    wall_frame_front = wall_frame_w_door(
-            verstas,
-            wall_height,
-            beams.get_high_normal(Dimension.Z),
-            floor_normal,
-            beams.get_low_normal(Dimension.Y).flipped(),
-            wall_frame_left.get_high_normal(Dimension.X),
-            wall_frame_right.get_low_normal(Dimension.X))
-
-    wall_frame_back = wall_frame(
-            verstas,
-            wall_height,
-            beams.get_high_normal(Dimension.Z),
-            floor_normal,
-            beams.get_high_normal(Dimension.Y).flipped(),
-            wall_frame_right.get_low_normal(Dimension.X),
-            wall_frame_left.get_high_normal(Dimension.X))
-
-    b_frame = floor_support(
-            verstas,
-            beams.get_high_normal(Dimension.Z),
-            wall_frame_left.get_high_normal(Dimension.X),
-            wall_frame_right.get_low_normal(Dimension.X),
-            beams.get_low_normal(Dimension.Y).flipped(),
-            beams.get_high_normal(Dimension.Y).flipped())
+    with verstas.assembly("left wall"):
+        wall_frame_left = wall_frame_w_corners(
+                verstas,
+                wall_height,
+                beams.get_high_normal(Dimension.Z),
+                floor_normal,
+                beams.get_low_normal(Dimension.X).flipped(),
+                beams.get_low_normal(Dimension.Y).flipped(),
+                beams.get_high_normal(Dimension.Y).flipped(),
+                stud_spacing)
+
+    with verstas.assembly("right wall"):
+        wall_frame_right = wall_frame_w_corners(
+                verstas,
+                wall_height,
+                beams.get_high_normal(Dimension.Z),
+                floor_normal,
+                beams.get_high_normal(Dimension.X).flipped(),
+                beams.get_low_normal(Dimension.Y).flipped(),
+                beams.get_high_normal(Dimension.Y).flipped(),
+                stud_spacing)
+
+    with verstas.assembly("front wall"):
+        wall_frame_front = wall_frame_w_door(
+                verstas,
+                wall_height,
+                beams.get_high_normal(Dimension.Z),
+                floor_normal,
+                beams.get_low_normal(Dimension.Y).flipped(),
+                wall_frame_left.get_high_normal(Dimension.X),
+                wall_frame_right.get_low_normal(Dimension.X),
+                stud_spacing,
+                door_template)
+
+    with verstas.assembly("back wall"):
+        wall_frame_back = wall_frame(
+                verstas,
+                wall_height,
+                beams.get_high_normal(Dimension.Z),
+                floor_normal,
+                beams.get_high_normal(Dimension.Y).flipped(),
+                wall_frame_right.get_low_normal(Dimension.X),
+                wall_frame_left.get_high_normal(Dimension.X),
+                stud_spacing)
+
+    with verstas.assembly("floor"):
+        b_frame = floor_support(
+                verstas,
+                beams.get_high_normal(Dimension.Z),
+                wall_frame_left.get_high_normal(Dimension.X),
+                wall_frame_right.get_low_normal(Dimension.X),
+                beams.get_low_normal(Dimension.Y).flipped(),
+                beams.get_high_normal(Dimension.Y).flipped(),
+                stud_spacing)
     b_frame.get_high_normal(Dimension.Z).bind(floor_normal)
 
     #wall_frame_front.get_low_face(Dimension.Y).bind(
     #        wall_frame_back.get_high_face(Dimension.Y), offset=3000)
     wall_frame_left.get_low_face(Dimension.X).bind(
-            wall_frame_right.get_high_face(Dimension.X), offset=3000)
+            wall_frame_right.get_high_face(Dimension.X), offset=wall_width)
 
     front_cladding_inner_normal = Normal(Face(Dimension.Y), True)
     back_cladding_inner_normal = Normal(Face(Dimension.Y), False)
 
-    cladding_right, cladding_right_inner = board_on_board(
-            verstas,
-            front_cladding_inner_normal,
-            back_cladding_inner_normal,
-            wall_frame_right.get_low_normal(Dimension.Z).flipped(),
-            wall_frame_right.get_high_normal(Dimension.Z).flipped(),
-            wall_frame_right.get_high_normal(Dimension.X))
-
-    cladding_left, cladding_left_inner = board_on_board(
-            verstas,
-            front_cladding_inner_normal,
-            back_cladding_inner_normal,
-            wall_frame_left.get_low_normal(Dimension.Z).flipped(),
-            wall_frame_left.get_high_normal(Dimension.Z).flipped(),
-            wall_frame_left.get_low_normal(Dimension.X))
-
-    cladding_front, cladding_front_inner = board_on_board(
-            verstas,
-            cladding_left_inner.get_low_normal(Dimension.X).flipped(),
-            cladding_right_inner.get_high_normal(Dimension.X).flipped(),
-            wall_frame_front.get_low_normal(Dimension.Z).flipped(),
-            wall_frame_front.get_high_normal(Dimension.Z).flipped(),
-            wall_frame_front.get_low_normal(Dimension.Y))
-
-    cladding_back, cladding_back_inner = board_on_board(
-            verstas,
-            cladding_left_inner.get_low_normal(Dimension.X).flipped(),
-            cladding_right_inner.get_high_normal(Dimension.X).flipped(),
-            wall_frame_back.get_low_normal(Dimension.Z).flipped(),
-            wall_frame_back.get_high_normal(Dimension.Z).flipped(),
-            wall_frame_back.get_high_normal(Dimension.Y))
+    with verstas.assembly("right cladding"):
+        cladding_right, cladding_right_inner = board_on_board(
+                verstas,
+                front_cladding_inner_normal,
+                back_cladding_inner_normal,
+                wall_frame_right.get_low_normal(Dimension.Z).flipped(),
+                wall_frame_right.get_high_normal(Dimension.Z).flipped(),
+                wall_frame_right.get_high_normal(Dimension.X))
+
+    with verstas.assembly("left cladding"):
+        cladding_left, cladding_left_inner = board_on_board(
+                verstas,
+                front_cladding_inner_normal,
+                back_cladding_inner_normal,
+                wall_frame_left.get_low_normal(Dimension.Z).flipped(),
+                wall_frame_left.get_high_normal(Dimension.Z).flipped(),
+                wall_frame_left.get_low_normal(Dimension.X))
+
+    with verstas.assembly("front cladding"):
+        cladding_front, cladding_front_inner = board_on_board(
+                verstas,
+                cladding_left_inner.get_low_normal(Dimension.X).flipped(),
+                cladding_right_inner.get_high_normal(Dimension.X).flipped(),
+                wall_frame_front.get_low_normal(Dimension.Z).flipped(),
+                wall_frame_front.get_high_normal(Dimension.Z).flipped(),
+                wall_frame_front.get_low_normal(Dimension.Y))
+
+    with verstas.assembly("back cladding"):
+        cladding_back, cladding_back_inner = board_on_board(
+                verstas,
+                cladding_left_inner.get_low_normal(Dimension.X).flipped(),
+                cladding_right_inner.get_high_normal(Dimension.X).flipped(),
+                wall_frame_back.get_low_normal(Dimension.Z).flipped(),
+                wall_frame_back.get_high_normal(Dimension.Z).flipped(),
+                wall_frame_back.get_high_normal(Dimension.Y))
 
     front_cladding_inner_normal.bind(cladding_front_inner.get_high_normal(Dimension.Y))
     back_cladding_inner_normal.bind(cladding_back_inner.get_low_normal(Dimension.Y))
     #front_cladding_inner_normal.bind(back_cladding_inner_normal, 3000)
 
     cladding_left.get_low_face(Dimension.X).bind(
-            cladding_right.get_high_face(Dimension.X), math.sqrt(10000000))
+            cladding_right.get_high_face(Dimension.X), cladding_width)
     cladding_front.get_low_face(Dimension.Y).bind(
-            cladding_back.get_high_face(Dimension.Y), math.sqrt(10000000))
+            cladding_back.get_high_face(Dimension.Y), cladding_depth)
+
+    with verstas.assembly("pillars"):
+        pillars(verstas, beam_blocks[0])
+        pillars(verstas, beam_blocks[1])
+        pillars(verstas, beam_blocks[2])
+
+def report_problems(verstas):
+    # Prints what would make the model wrong, returns True if anything was
+    # found.
+    problems = False
+    for deferred in verstas.unsatisfied_binds():
+        print("Unsatisfied bind:", deferred, file=sys.stderr)
+        problems = True
+    report = verstas.find_underconstrained()
+    if report:
+        print(report.format(), file=sys.stderr)
+        problems = True
+    conflicts = verstas.find_conflicts()
+    if conflicts:
+        print(conflicts.format(), file=sys.stderr)
+        problems = True
+    return problems
+
+def number(text):
+    # ints stay ints, so the output is the same as with the defaults
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
 
-    pillars(verstas, beam_blocks[0])
-    pillars(verstas, beam_blocks[1])
-    pillars(verstas, beam_blocks[2])
+def build(args):
+    verstas = WoodSystem()
+    shed(verstas, wall_width=args.wall_width, wall_height=args.wall_height,
+            stud_spacing=args.stud_spacing)
+    return verstas
+
+def solve_command(args):
+    verstas = build(args)
+    report_problems(verstas)
+    start = time.perf_counter()
+    verstas.solve(parallel=args.parallel)
+    print("Solved {} blocks in {:.3f} s.".format(
+        len(verstas.blocks), time.perf_counter() - start))
+    return 0
+
+def export_command(args):
+    verstas = build(args)
+    report_problems(verstas)
+    verstas.solve()
+    if args.parts:
+        manifest = verstas.create_parts(args.parts, args.format or "scad",
+                args.processes, underconstrained="skip")
+        print("Wrote {} parts to {}.".format(
+            len(manifest["parts"]), args.parts))
+        return 0
+    output = args.output or "verstas." + (args.format or "scad")
+    format = args.format or os.path.splitext(output)[1][1:].lower()
+    if format == "scad":
+        verstas.create_openscad(output, streaming=args.streaming,
+                underconstrained="flag")
+    else:
+        verstas.create_mesh(output, format, underconstrained="skip")
+    return 0
 
-    for i, lazy in enumerate(lazys):
-        try:
-            lazy()
-        except:
-            debug()
+def bom_command(args):
+    verstas = build(args)
     verstas.solve()
-    verstas.create_openscad()
+    cut_list = verstas.create_cut_list(
+            args.kerf, args.exact, not args.visible_only,
+            args.resolution, args.max_iterations)
+    print(cut_list.format())
+    return 0
+
+def check_command(args):
+    verstas = build(args)
+    return 1 if report_problems(verstas) else 0
+
+def main(argv=None):
+    # Without a command the model is exported into verstas.scad. Modules
+    # that are slow to import (SolidPython, NumPy, the benchmarks) are
+    # imported by the commands that need them, see benchmark.py --startup.
+    import argparse
+    parser = argparse.ArgumentParser(description="Build the Vaja shed.")
+    parser.set_defaults(command=export_command, output=None, format=None,
+            parts=None, streaming=False, wall_width=3000, wall_height=2700,
+            stud_spacing=600)
+    model = argparse.ArgumentParser(add_help=False)
+    model.add_argument("--wall-width", type=number, default=3000)
+    model.add_argument("--wall-height", type=number, default=2700)
+    model.add_argument("--stud-spacing", type=number, default=600)
+    commands = parser.add_subparsers(title="commands")
+
+    solve_parser = commands.add_parser("solve", parents=[model],
+            help="build and solve the model")
+    solve_parser.add_argument("--parallel", action="store_true",
+            help="solve the partitions in a process pool")
+    solve_parser.set_defaults(command=solve_command)
+
+    export_parser = commands.add_parser("export", parents=[model],
+            help="write the model, verstas.scad by default")
+    export_parser.add_argument("-o", "--output",
+            help="output file, the format comes from its extension")
+    export_parser.add_argument("-f", "--format",
+            choices=("scad", "stl", "obj", "ply"))
+    export_parser.add_argument("--streaming", action="store_true",
+            help="write SCAD without SolidPython")
+    export_parser.add_argument("--parts", metavar="DIRECTORY",
+            help="write a file per board and assembly instead")
+    export_parser.add_argument("--processes", type=int,
+            help="processes for writing the parts")
+    export_parser.set_defaults(command=export_command)
+
+    bom_parser = commands.add_parser("bom", parents=[model],
+            help="print the cut list")
+    bom_parser.add_argument("--kerf", type=float, default=0)
+    bom_parser.add_argument("--exact", action="store_true",
+            help="search for the fewest bars")
+    bom_parser.add_argument("--resolution", type=number, default=1,
+            help="length step of the --exact search")
+    bom_parser.add_argument("--max-iterations", type=int, default=100,
+            help="pattern searches of --exact at most")
+    bom_parser.add_argument("--visible-only", action="store_true",
+            help="leave out the hidden boards")
+    bom_parser.set_defaults(command=bom_command)
+
+    check_parser = commands.add_parser("check", parents=[model],
+            help="report unsatisfied binds, unsolvable blocks and conflicts")
+    check_parser.set_defaults(command=check_command)
+
+    # only listed here, the arguments are benchmark.py's own
+    commands.add_parser("bench",
+            help="run benchmark.py with the rest of the arguments")
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == ["bench"]:
+        import benchmark
+        # "bench -- --quick" works too
+        return benchmark.main(argv[2:] if argv[1:2] == ["--"] else argv[1:])
+    args = parser.parse_args(argv)
+    return args.command(args)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,10 +1,12 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import os
 import sys
-from solid import *
+import itertools
 
 from constraint_system import *
+import scad_writer
 
 woods = {
         "100x100": {"width": 100, "thickness": 100, "max_length": 6000},
@@ -22,16 +24,21 @@ class WoodBlock(ConstrainedBlock):
         self.visible = True
         system.add(self)
 
-    def get_openscad(self):
+    def get_box(self):
         length_x = self.get_computed_length(Dimension.X)
         length_y = self.get_computed_length(Dimension.Y)
         length_z = self.get_computed_length(Dimension.Z)
         translation_x = self.get_position(Dimension.X)
         translation_y = self.get_position(Dimension.Y)
         translation_z = self.get_position(Dimension.Z)
+        return ([translation_x, translation_y, translation_z],
+                [length_x, length_y, length_z])
 
-        new_cube = cube([length_x, length_y, length_z])
-        new_cube = translate([translation_x, translation_y, translation_z])(new_cube)
+    def get_openscad(self):
+        translation, size = self.get_box()
+        import solid
+        new_cube = solid.cube(size)
+        new_cube = solid.translate(translation)(new_cube)
         return new_cube
 
     def make_hole(self, hole_block):
@@ -44,6 +51,7 @@ class WoodSystem(ConstraintSystem):
     def get_wood(self, name, length_dimension, width_dimension, visible=True):
         new_block = WoodBlock(self)
         new_block.visible = visible
+        new_block.material = name
         new_block.length_dimension = length_dimension
         thickness_dimension = next((d for d in Dimension
             if d is not length_dimension and d is not width_dimension))
@@ -57,11 +65,111 @@ class WoodSystem(ConstraintSystem):
     def get_material_thickness(self, name):
         return woods[name]["thickness"]
 
-    def create_openscad(self):
-        openscad_object = union()()
-        for block in self.blocks:
+    def create_cut_list(
+            self, kerf=0, exact=False, include_hidden=True,
+            resolution=1, max_iterations=100):
+        import cut_list
+        return cut_list.create_cut_list(self, kerf, exact, include_hidden,
+                resolution=resolution, max_iterations=max_iterations)
+
+    def get_exported_blocks(
+            self, underconstrained="raise", flagged=None, blocks=None):
+        # Visible blocks, of all blocks and placed templates or the given
+        # ones. Blocks that couldn't be solved raise
+        # UnderconstrainedException, or with "skip" or "flag" they are left
+        # out and appended to flagged.
+        if underconstrained not in ("raise", "skip", "flag"):
+            raise ValueError("Unknown underconstrained: " + underconstrained)
+        if blocks is None:
+            blocks = itertools.chain(self.blocks, self.placed_blocks())
+        for block in blocks:
             if not block.visible:
                 continue
-            openscad_object += block.get_openscad()
+            if underconstrained != "raise" and block.get_extent() is None:
+                if flagged is not None:
+                    flagged.append(block)
+                continue
+            yield block
+
+    def get_boxes(self, underconstrained="raise", flagged=None, blocks=None):
+        for block in self.get_exported_blocks(
+                underconstrained, flagged, blocks):
+            yield block.get_box()
+
+    def create_openscad(
+            self, output='verstas.scad', streaming=False, instanced=False,
+            underconstrained="raise", blocks=None):
+        # underconstrained: "raise", "skip" to leave the blocks out or
+        # "flag" to also list them in comments at the end of the file.
+        # blocks: export only these, see ConstraintSystem.solve_partial.
+        flagged = []
+        if instanced:
+            scad_writer.write_instanced_boxes(
+                    self.get_boxes(underconstrained, flagged, blocks), output)
+        elif streaming:
+            scad_writer.write_boxes(
+                    self.get_boxes(underconstrained, flagged, blocks), output)
+        else:
+            # SolidPython is slow to import, only this export needs it
+            import solid
+            openscad_object = solid.union()()
+            for block in self.get_exported_blocks(
+                    underconstrained, flagged, blocks):
+                openscad_object += block.get_openscad()
+
+            if isinstance(output, (str, os.PathLike)):
+                solid.scad_render_to_file(openscad_object, output)
+            else:
+                output.write(solid.scad_render(openscad_object))
+
+        if underconstrained == "flag" and flagged:
+            scad_writer.write_comments(
+                    ("Underconstrained: " + block.describe()
+                        for block in flagged), output)
+
+    def create_mesh(
+            self, output='verstas.stl', format=None,
+            underconstrained="raise", blocks=None):
+        # Meshes of the boxes without OpenSCAD, see mesh_writer.py.
+        # format: "stl", "obj" or "ply", by default from the file name.
+        # Underconstrained blocks are left out with "skip" or "flag", and
+        # returned.
+        import mesh_writer
+        if format is None:
+            format = (os.path.splitext(output)[1][1:].lower()
+                    if isinstance(output, (str, os.PathLike)) else "stl")
+        if format not in ("stl", "obj", "ply"):
+            raise ValueError("Unknown mesh format: " + format)
+        flagged = []
+        exported = list(self.get_exported_blocks(
+            underconstrained, flagged, blocks))
+        boxes = [block.get_box() for block in exported]
+        if format == "stl":
+            mesh_writer.write_stl(boxes, output)
+        else:
+            names = [board_name(i, block) for i, block in enumerate(exported)]
+            if format == "obj":
+                mesh_writer.write_obj(boxes, names, output)
+            else:
+                mesh_writer.write_ply(boxes, names, output)
+        return flagged
+
+    def create_parts(
+            self, directory='parts', format="scad", processes=None,
+            underconstrained="raise", blocks=None):
+        # A file per board and per assembly with a manifest, see
+        # part_export.py. Returns the manifest.
+        import part_export
+        exported = list(self.get_exported_blocks(
+            underconstrained, None, blocks))
+        names = [board_name(i, block) for i, block in enumerate(exported)]
+        return part_export.write_parts(
+                exported, names, directory, format, processes)
 
-        scad_render_to_file(openscad_object, 'verstas.scad')
+def board_name(index, block):
+    # Unique name of an exported block without whitespace, with the name
+    # or the material of the block when it has one.
+    label = getattr(block, "name", None) or getattr(block, "material", None)
+    if label is None:
+        return "board_{}".format(index)
+    return "board_{}_{}".format(index, "_".join(str(label).split()))